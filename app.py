@@ -5,48 +5,121 @@ VERSIONE: 2.0 ENTERPRISE
 """
 
 import os
+import csv
 import json
 import time
 import random
 import re
 import hashlib
+import heapq
+import math
+import base64
 import uuid
 import secrets
 import threading
+import tempfile
+import itertools
+import bisect
+import shutil
+import importlib
+from importlib.util import find_spec
+from copy import copy
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
-from io import BytesIO
-from urllib.parse import urlparse, urljoin
+from collections import OrderedDict, deque
+from html import unescape
+from io import BytesIO, StringIO
+from urllib.parse import urlparse, urljoin, parse_qsl, urlencode, quote
+from urllib.robotparser import RobotFileParser
 from functools import wraps
 
 # Core
-from flask import Flask, request, jsonify, send_file, render_template, session
+from flask import (Blueprint, Flask, Response, current_app, request, jsonify, send_file, render_template, session,
+                   has_app_context, stream_with_context)
 from flask_cors import CORS
 from dotenv import load_dotenv
 
-# Scraping stealth
-import cloudscraper
-from bs4 import BeautifulSoup
 import requests
-from fake_useragent import UserAgent
-
-# Excel Professional
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
-from openpyxl.drawing.image import Image as XLImage
-from openpyxl.utils import get_column_letter
-from PIL import Image, ImageDraw, ImageFont
+from requests.adapters import HTTPAdapter
 
 # Database
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-import jwt
+from sqlalchemy import event, inspect as db_inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as DBSession
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug.utils import send_file as send_file_offload
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Stripe (opzionale)
+class LazyImport:
+    """
+    Modulo (o suo attributo) importato al primo uso: openpyxl, PIL, bs4, cloudscraper,
+    stripe, numpy e jwt non pesano sull'avvio dei worker né sugli endpoint che non
+    li usano. warm_imports() li carica tutti (hook di gunicorn).
+    """
+    
+    registry = []
+    
+    def __init__(self, module, attr=None):
+        self._module_name = module
+        self._attr = attr
+        self._target = None
+        LazyImport.registry.append(self)
+    
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+    
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+    
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+# Scraping stealth
+cloudscraper = LazyImport('cloudscraper')
+BeautifulSoup = LazyImport('bs4', 'BeautifulSoup')
+SoupStrainer = LazyImport('bs4', 'SoupStrainer')
+builder_registry = LazyImport('bs4.builder', 'builder_registry')
+UserAgent = LazyImport('fake_useragent', 'UserAgent')
+
+# Excel Professional
+Workbook = LazyImport('openpyxl', 'Workbook')
+Font = LazyImport('openpyxl.styles', 'Font')
+PatternFill = LazyImport('openpyxl.styles', 'PatternFill')
+Alignment = LazyImport('openpyxl.styles', 'Alignment')
+Border = LazyImport('openpyxl.styles', 'Border')
+Side = LazyImport('openpyxl.styles', 'Side')
+NamedStyle = LazyImport('openpyxl.styles', 'NamedStyle')
+XLImage = LazyImport('openpyxl.drawing.image', 'Image')
+WriteOnlyCell = LazyImport('openpyxl.cell', 'WriteOnlyCell')
+get_column_letter = LazyImport('openpyxl.utils', 'get_column_letter')
+Image = LazyImport('PIL.Image')
+ImageDraw = LazyImport('PIL.ImageDraw')
+ImageFont = LazyImport('PIL.ImageFont')
+
+jwt = LazyImport('jwt')
+
+# NumPy (opzionale): prezzi dell'intero catalogo in blocco
+NUMPY_AVAILABLE = find_spec('numpy') is not None
+np = LazyImport('numpy')
+
+# Lock tra processi per la pulizia export (non disponibile su Windows)
 try:
-    import stripe
-    STRIPE_AVAILABLE = True
-except:
-    STRIPE_AVAILABLE = False
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Redis (opzionale): stato di ammissione condiviso tra worker e istanze
+REDIS_AVAILABLE = find_spec('redis') is not None
+redis = LazyImport('redis')
+
+# Stripe (opzionale)
+STRIPE_AVAILABLE = find_spec('stripe') is not None
+stripe = LazyImport('stripe')
 
 # ====================================
 # CONFIGURAZIONE B2B ENTERPRISE
@@ -60,9 +133,26 @@ class Config:
     PORT = int(os.environ.get('PORT', '8080'))  # PORTA 8080 FISSA
     DOMAIN = os.environ.get('DOMAIN', 'https://luxlabconvertitore.it')
     
+    # Autenticazione: snapshot utente/piano per processo e hashing password su pool dedicato
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '30'))  # 0 = disattivata
+    USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', '32'))  # Oltre: 503
+    
     # Database
     DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///luxlab_b2b.db')
     
+    # SQLite con più worker: WAL (letture senza bloccare le scritture) e attesa del lock
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', '10000'))  # ms
+    SQLITE_CACHE_MB = int(os.environ.get('SQLITE_CACHE_MB', '16'))
+    
+    # Pool connessioni per PostgreSQL/MySQL (per processo)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', '1800'))  # Prima dei timeout lato server
+    
     # Stripe
     STRIPE_PUBLIC_KEY = os.environ.get('STRIPE_PUBLIC_KEY', 'pk_live_51RZ7koDFq5tpJ2dVCN9QMOhjrueMjs905Jh5iZCKYG7Axhn1HxK489yIXTnLPLo5a3qz2WMIpYNJWBgeKsUSVbTP00ZWEJEEeT')
     STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
@@ -82,6 +172,8 @@ class Config:
             'competitor_analysis': True,  # AI INCLUSA NEL TRIAL!
             'custom_strategy': False,
             'validity_days': 1,
+            'export_quota_mb': 50,  # Spazio export conservato (None = illimitato)
+            'admission': {'concurrent': 1, 'per_minute': 10, 'burst': 5, 'priority': 1},  # None = senza limite
             'description': '🎁 1 TOKEN GRATUITO - 10 prodotti con immagini HD + AI analysis'
         },
         'base': {
@@ -92,6 +184,8 @@ class Config:
             'competitor_analysis': False,  # NO AI
             'custom_strategy': False,
             'validity_days': 30,
+            'export_quota_mb': 500,
+            'admission': {'concurrent': 1, 'per_minute': 20, 'burst': 10, 'priority': 2},
             'description': 'Excel base senza immagini, senza AI intelligence'
         },
         'professional': {
@@ -102,6 +196,8 @@ class Config:
             'competitor_analysis': True,  # COMPETITOR INTELLIGENCE AI INCLUSA
             'custom_strategy': True,  # Strategie personalizzate
             'validity_days': 30,
+            'export_quota_mb': 2048,
+            'admission': {'concurrent': 2, 'per_minute': 30, 'burst': 15, 'priority': 2},
             'description': '🤖 AI COMPLETA - CompetitorIntelligence + Immagini HD + Smart Pricing'
         },
         'enterprise': {
@@ -114,6 +210,8 @@ class Config:
             'api_access': True,  # Accesso API
             'white_label': True,  # White label
             'validity_days': 365,
+            'export_quota_mb': 20480,
+            'admission': {'concurrent': 2, 'per_minute': 60, 'burst': 20, 'priority': 2},
             'description': '♾️ TUTTO ILLIMITATO + AI + API + White Label + Support VIP'
         },
         'vip': {
@@ -124,6 +222,8 @@ class Config:
             'competitor_analysis': True,
             'custom_strategy': True,
             'validity_days': 9999,
+            'export_quota_mb': None,
+            'admission': {'concurrent': 3, 'per_minute': 120, 'burst': 40, 'priority': 3},
             'description': 'Account VIP - Accesso completo illimitato'
         },
         'admin': {
@@ -134,6 +234,8 @@ class Config:
             'competitor_analysis': True,
             'custom_strategy': True,
             'validity_days': 9999,
+            'export_quota_mb': None,
+            'admission': {'concurrent': None, 'per_minute': None, 'burst': None, 'priority': 3},
             'description': 'Account amministratore - Accesso completo al sistema'
         }
     }
@@ -151,30 +253,302 @@ class Config:
     MIN_DELAY = 0.5
     MAX_DELAY = 2.0
     MAX_RETRIES = 5
+    
+    # Client HTTP condivisi dal processo: keep-alive e pool di connessioni per host
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '32'))  # Host con pool aperto
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '16'))  # Connessioni tenute per host
+    HTTP_HOST_POOL_SIZES = {}  # Pool specifici: {'cdn.esempio.com': 32}
+    HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+    HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+    HTTP_IMAGE_READ_TIMEOUT = float(os.environ.get('HTTP_IMAGE_READ_TIMEOUT', '10'))
+    
+    # Ricerche competitor in parallelo: unica scadenza, complessiva per prodotto
+    COMPETITOR_WORKERS = int(os.environ.get('COMPETITOR_WORKERS', '16'))
+    COMPETITOR_DEADLINE = float(os.environ.get('COMPETITOR_DEADLINE', '8'))
+    
+    # Analisi in batch: modelli unici analizzati in parallelo, a blocchi di righe
+    MARKET_BATCH_WORKERS = int(os.environ.get('MARKET_BATCH_WORKERS', '4'))
+    MARKET_BATCH_ROWS = int(os.environ.get('MARKET_BATCH_ROWS', '500'))
+    
+    # Cache analisi di mercato (memoria per processo + tabella market_analyses)
+    MARKET_CACHE_TTL = int(os.environ.get('MARKET_CACHE_TTL', str(24 * 3600)))
+    MARKET_CACHE_MAX_ENTRIES = int(os.environ.get('MARKET_CACHE_MAX_ENTRIES', '10000'))
+    
+    # Job engine conversioni in background
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+    JOB_TTL = int(os.environ.get('JOB_TTL', '3600'))  # Secondi di conservazione job terminati
+    
+    # Ammissione richieste pesanti (convert/analyze/export): limiti per piano in PLANS['admission']
+    ANONYMOUS_ADMISSION = {'concurrent': 1, 'per_minute': 6, 'burst': 3, 'priority': 0}  # Per IP
+    # Proxy fidati davanti all'app (es. 1 con nginx): l'IP client si legge da X-Forwarded-For.
+    # Lasciare 0 se l'app è raggiungibile direttamente, altrimenti l'header è falsificabile
+    TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', '0'))
+    CONVERSION_SLOTS = int(os.environ.get('CONVERSION_SLOTS', '8'))  # Per processo
+    # Quota dei posti occupabile dalle corsie fino a quella priorità: le superiori trovano sempre posto
+    LANE_SHARES = {0: 0.25, 1: 0.5, 2: 0.875}
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '5'))
+    ADMISSION_MAX_KEYS = 100000
+    ADMISSION_REDIS_URL = os.environ.get('ADMISSION_REDIS_URL', '')
+    ADMISSION_LEASE = 3600  # Secondi oltre i quali un posto non rilasciato (worker morto) scade
+    
+    # Riuso conversioni: stesso catalogo e stesse opzioni entro la finestra (0 = disattivato)
+    RESULT_REUSE_TTL = int(os.environ.get('RESULT_REUSE_TTL', '900'))
+    
+    # Storico conversioni (/api/user/conversions)
+    HISTORY_PAGE_SIZE = 20
+    HISTORY_MAX_PAGE_SIZE = 100
+    
+    # Pipeline immagini: download paralleli limitati per host + pool di elaborazione PIL
+    IMAGE_DOWNLOAD_WORKERS = int(os.environ.get('IMAGE_DOWNLOAD_WORKERS', '16'))
+    IMAGE_PROCESS_WORKERS = int(os.environ.get('IMAGE_PROCESS_WORKERS', str(os.cpu_count() or 4)))
+    IMAGE_PROCESS_MODE = os.environ.get('IMAGE_PROCESS_MODE', 'thread')  # 'thread' o 'process'
+    IMAGE_HOST_DEFAULT_CONCURRENCY = int(os.environ.get('IMAGE_HOST_CONCURRENCY', '4'))
+    IMAGE_HOST_CONCURRENCY = {}  # Limiti specifici: {'cdn.esempio.com': 8}
+    
+    # Elaborazione immagini (fanno parte della chiave della cache su disco)
+    IMAGE_MAX_SIZE = 800
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '95'))
+    IMAGE_OPTIMIZE = os.environ.get('IMAGE_OPTIMIZE', '1') == '1'
+    IMAGE_PROGRESSIVE = os.environ.get('IMAGE_PROGRESSIVE', '0') == '1'
+    IMAGE_WATERMARK = 'LUXLAB'
+    IMAGE_WATERMARK_OPACITY = 128
+    IMAGE_CACHE_MAX_MB = int(os.environ.get('IMAGE_CACHE_MAX_MB', '512'))
+    IMAGE_CACHE_PATH = os.path.join(TEMP_PATH, 'cache')
+    IMAGE_BLOB_PATH = os.path.join(TEMP_PATH, 'blobs')  # Immagini delle conversioni in corso
+    
+    # Parsing HTML: 'auto' (lxml se installato, altrimenti html.parser), 'lxml', 'html.parser', 'html5lib'
+    HTML_PARSER = os.environ.get('HTML_PARSER', 'auto')
+    HTML_TARGETED_PARSE = os.environ.get('HTML_TARGETED_PARSE', '1') == '1'  # Costruisce solo i contenitori prodotto
+    
+    # Crawling catalogo: paginazione con fetch in pipeline, limiti per host e robots.txt
+    CRAWL_WORKERS = int(os.environ.get('CRAWL_WORKERS', '8'))
+    CRAWL_HOST_CONCURRENCY = int(os.environ.get('CRAWL_HOST_CONCURRENCY', '2'))
+    CRAWL_PREFETCH_PAGES = int(os.environ.get('CRAWL_PREFETCH_PAGES', '3'))  # Pagine numerate richieste in anticipo
+    CRAWL_MAX_PAGES = int(os.environ.get('CRAWL_MAX_PAGES', '50'))
+    CRAWL_RESPECT_ROBOTS = os.environ.get('CRAWL_RESPECT_ROBOTS', '1') == '1'
+    CRAWL_ROBOTS_TTL = 3600
+    PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', '300'))  # Oltre si rivalida con ETag/Last-Modified
+    PAGE_CACHE_MAX_MB = int(os.environ.get('PAGE_CACHE_MAX_MB', '64'))
+    
+    # Retention export: età massima, tetto complessivo e quote per piano ('export_quota_mb')
+    EXPORT_MAX_AGE_DAYS = int(os.environ.get('EXPORT_MAX_AGE_DAYS', '30'))
+    EXPORT_ORPHAN_MAX_AGE_HOURS = int(os.environ.get('EXPORT_ORPHAN_MAX_AGE_HOURS', '24'))  # Export anonimi
+    EXPORT_MAX_TOTAL_MB = int(os.environ.get('EXPORT_MAX_TOTAL_MB', '10240'))
+    EXPORT_MIN_AGE_SECONDS = 600  # Un export appena creato resta sempre scaricabile
+    EXPORT_JANITOR_INTERVAL = int(os.environ.get('EXPORT_JANITOR_INTERVAL', '3600'))
+    
+    # Download export: ETag forte dal contenuto e Range; file serviti dal proxy se configurato
+    DOWNLOAD_OFFLOAD = os.environ.get('DOWNLOAD_OFFLOAD', '')  # '', 'x-sendfile' (Apache/lighttpd), 'x-accel' (nginx)
+    X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-exports/')  # location internal nginx su EXPORT_PATH
+    
+    # Export streaming CSV/NDJSON: righe prezzate a blocchi piccoli per un primo byte rapido
+    EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', '40'))
+    EXPORT_FLUSH_BYTES = int(os.environ.get('EXPORT_FLUSH_BYTES', '16384'))
+    
+    # Excel: oltre questa soglia si usa il writer write-only in streaming
+    EXCEL_STREAMING_ROWS = int(os.environ.get('EXCEL_STREAMING_ROWS', '1000'))
+    
+    # Metriche Prometheus (/api/metrics): bucket in secondi degli istogrammi di fase
+    METRICS_BUCKETS = tuple(float(bound) for bound in os.environ.get(
+        'METRICS_BUCKETS', '0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60'
+    ).split(','))
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # Se impostato, lo scraper deve inviarlo come Bearer
 
 # ====================================
 # INIZIALIZZAZIONE APP
 # ====================================
 
-app = Flask(__name__)
+def database_engine_options(url):
+    """Opzioni engine: attesa del lock per SQLite, pool dimensionato per i database server"""
+    if url.startswith('sqlite'):
+        return {'connect_args': {'timeout': Config.SQLITE_BUSY_TIMEOUT / 1000}}
+    return {
+        'pool_size': Config.DB_POOL_SIZE,
+        'max_overflow': Config.DB_MAX_OVERFLOW,
+        'pool_timeout': Config.DB_POOL_TIMEOUT,
+        'pool_recycle': Config.DB_POOL_RECYCLE,
+        'pool_pre_ping': True  # Connessioni chiuse dal server dopo un riavvio o un idle lungo
+    }
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Pragma per ogni nuova connessione SQLite (journal_mode WAL resta nel file)"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={Config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT}")
+    # In WAL, NORMAL sincronizza solo ai checkpoint: sicuro contro i crash dell'applicazione
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_MB * 1024}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+# Estensioni e route: legate all'app da create_app (in fondo al file)
+db = SQLAlchemy()
+api = Blueprint('api', __name__)
+
+_user_agents = None
+_user_agents_lock = threading.Lock()
+
+def get_user_agents():
+    """fake_useragent del processo (il dataset browser si carica al primo uso)"""
+    global _user_agents
+    with _user_agents_lock:
+        if _user_agents is None:
+            _user_agents = UserAgent()
+        return _user_agents
+
+def current_flask_app():
+    """App del contesto corrente, per i thread in background; altrimenti quella del modulo"""
+    return current_app._get_current_object() if has_app_context() else app
+
+# ====================================
+# 📈 METRICHE (FORMATO PROMETHEUS)
+# ====================================
+
+def _metric_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+def _metric_labels(names, values):
+    """Etichette nel formato di esposizione testuale (valori con escape)"""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    """Contatore monotono, una serie per combinazione di etichette"""
+    
+    kind = 'counter'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self.labelnames, key, value
 
-# Configurazioni
-app.config['SECRET_KEY'] = Config.SECRET_KEY
-app.config['SQLALCHEMY_DATABASE_URI'] = Config.DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['TEMPLATES_AUTO_RELOAD'] = True
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+class Histogram:
+    """Istogramma a bucket fissi (conteggi cumulativi, somma e numero di osservazioni)"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets or Config.METRICS_BUCKETS))
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)  # Bucket "le": valore <= limite
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        bucket_labels = self.labelnames + ('le',)
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', bucket_labels, key + (_metric_value(bound),), cumulative
+            yield f'{self.name}_sum', self.labelnames, key, total
+            yield f'{self.name}_count', self.labelnames, key, cumulative
 
-db = SQLAlchemy(app)
-CORS(app, supports_credentials=True)
-ua = UserAgent()
+class MetricsRegistry:
+    """
+    Metriche del processo, esposte su /api/metrics. Istogrammi e contatori sono
+    aggiornati dalla pipeline; i collector leggono al momento dello scrape le
+    statistiche già tenute da cache, pool e ammissione. Ogni worker gunicorn ha
+    le sue serie, distinte dall'etichetta worker (pid): si aggregano con sum().
+    """
+    
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+    
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=None):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def _register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+    
+    def collector(self, fn):
+        """Registra fn() -> iterabile di (nome, tipo, descrizione, etichette, valore)"""
+        with self.lock:
+            self.collectors.append(fn)
+        return fn
+    
+    def render(self):
+        """Formato di esposizione testuale Prometheus 0.0.4"""
+        worker = str(os.getpid())
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        
+        families = OrderedDict()
+        for metric in metrics:
+            samples = [(name, ('worker',) + labelnames, (worker,) + labelvalues, value)
+                       for name, labelnames, labelvalues, value in metric.samples()]
+            families[metric.name] = (metric.kind, metric.documentation, samples)
+        for collect in collectors:
+            try:
+                for name, kind, documentation, labels, value in collect():
+                    family = families.setdefault(name, (kind, documentation, []))
+                    family[2].append((name, ('worker',) + tuple(labels), (worker,) + tuple(labels.values()), value))
+            except Exception as e:
+                print(f"Errore metriche {collect.__name__}: {e}")
+        
+        lines = []
+        for family, (kind, documentation, samples) in families.items():
+            lines.append(f'# HELP {family} {documentation}')
+            lines.append(f'# TYPE {family} {kind}')
+            for name, labelnames, labelvalues, value in samples:
+                lines.append(f'{name}{_metric_labels(labelnames, labelvalues)} {_metric_value(value)}')
+        return '\n'.join(lines) + '\n'
 
-if STRIPE_AVAILABLE and Config.STRIPE_SECRET_KEY:
-    stripe.api_key = Config.STRIPE_SECRET_KEY
+metrics = MetricsRegistry()
 
-# Create directories
-for path in [Config.EXPORT_PATH, Config.TEMP_PATH, Config.LOGS_PATH]:
-    os.makedirs(path, exist_ok=True)
+# Fasi dei job (tempo esclusivo: le fasi annidate non contano in quella esterna) e fasi
+# eseguite nei pool condivisi (page_fetch, image_download, image_process)
+stage_seconds = metrics.histogram('luxlab_stage_seconds', 'Durata delle fasi della pipeline', ('stage',))
+fetched_bytes = metrics.counter('luxlab_fetched_bytes_total', 'Bytes scaricati dalla rete', ('kind',))
+pages_fetched = metrics.counter('luxlab_pages_total', 'Pagine di catalogo servite dal fetcher', ('source',))
+images_processed = metrics.counter('luxlab_images_total', 'Immagini prodotto per esito', ('result',))
 
 # ====================================
 # MODELLI DATABASE
@@ -199,10 +573,10 @@ class User(db.Model):
     total_conversions = db.Column(db.Integer, default=0)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
     
     def generate_token(self):
         self.token = f"LXB-{uuid.uuid4().hex[:12].upper()}"
@@ -242,12 +616,467 @@ class Conversion(db.Model):
     total_value = db.Column(db.Float)
     competitor_data = db.Column(db.Text)
     file_generated = db.Column(db.String(200))
+    include_images = db.Column(db.Boolean)
+    max_products = db.Column(db.Integer)
+    ai_analysis = db.Column(db.Boolean)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        # Ricerca di una conversione riutilizzabile (stesse opzioni, la più recente)
+        db.Index('ix_conversions_reuse', 'user_id', 'url_hash', 'strategy', 'include_images',
+                 'max_products', 'ai_analysis', 'created_at'),
+        # Storico utente paginato per (created_at, id) decrescenti
+        db.Index('ix_conversions_user_created', 'user_id', 'created_at', 'id'),
+        # Proprietario di un file export (pulizia per quota)
+        db.Index('ix_conversions_file', 'file_generated'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'strategy': self.strategy,
+            'productsCount': self.products_count,
+            'avgMargin': self.avg_margin,
+            'totalValue': self.total_value,
+            'includesImages': self.include_images,
+            'maxProducts': self.max_products,
+            'aiAnalysis': self.ai_analysis,
+            'marketData': json.loads(self.competitor_data) if self.competitor_data else None,
+            'downloadUrl': f"/api/download/{self.file_generated}" if self.file_generated else None,
+            'createdAt': self.created_at.isoformat() if self.created_at else None
+        }
+
+class MarketAnalysis(db.Model):
+    """Cache persistente di CompetitorIntelligence.analyze_market"""
+    __tablename__ = 'market_analyses'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now, index=True)
+
+# ====================================
+# 🔐 AUTENTICAZIONE: CACHE UTENTI E HASHING
+# ====================================
+
+class UserSnapshot:
+    """Copia in sola lettura dei campi di User che servono ad autorizzare una richiesta"""
+    
+    __slots__ = ('id', 'email', 'plan', 'is_admin', 'is_active', 'subscription_end')
+    
+    def __init__(self, user):
+        for field in self.__slots__:
+            setattr(self, field, getattr(user, field))
+    
+    get_plan_limits = User.get_plan_limits
+    can_use_images = User.can_use_images
+    can_analyze_competitors = User.can_analyze_competitors
+
+class UserCache:
+    """
+    Snapshot utente/piano per processo, con TTL breve: le richieste autenticate
+    evitano la query su users. Le modifiche via ORM invalidano la voce (after_update);
+    dopo UPDATE in blocco su piano o permessi chiamare invalidate_user. Negli altri
+    worker la voce vecchia dura al massimo USER_CACHE_TTL secondi.
+    """
+    
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, user_id):
+        """Snapshot dell'utente (None se non esiste)"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        user = db.session.get(User, user_id)
+        snapshot = UserSnapshot(user) if user else None
+        if snapshot and self.ttl > 0:
+            with self.lock:
+                self.entries[user_id] = (now + self.ttl, snapshot)
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return snapshot
+    
+    def invalidate(self, user_id=None):
+        """Scarta un utente (o tutti, senza argomenti)"""
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(user_id, None)
+            self.invalidations += 1
+    
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+                'invalidations': self.invalidations
+            }
+
+user_cache = UserCache(Config.USER_CACHE_TTL, Config.USER_CACHE_MAX_ENTRIES)
+
+def invalidate_user(user_id=None):
+    user_cache.invalidate(user_id)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_snapshot(mapper, connection, target):
+    invalidate_user(target.id)
+
+class PasswordHashBusy(Exception):
+    """Troppi hash password in coda: la richiesta va ripetuta più tardi"""
+
+class PasswordHasher:
+    """
+    PBKDF2 su un pool piccolo e dedicato: a un picco di registrazioni/login solo
+    PASSWORD_HASH_WORKERS hash girano insieme e la CPU resta agli altri endpoint.
+    Oltre PASSWORD_HASH_QUEUE richieste in attesa si risponde subito 503.
+    """
+    
+    def __init__(self, workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='luxlab-hash')
+        self.slots = threading.BoundedSemaphore(max_pending)
+    
+    def run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PasswordHashBusy('Troppe richieste di accesso, riprova tra qualche secondo')
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+_password_hasher = None
+_password_hasher_lock = threading.Lock()
+
+def get_password_hasher():
+    """Pool hashing del processo (creato al primo uso, dopo il fork dei worker)"""
+    global _password_hasher
+    with _password_hasher_lock:
+        if _password_hasher is None:
+            _password_hasher = PasswordHasher(Config.PASSWORD_HASH_WORKERS, Config.PASSWORD_HASH_QUEUE)
+        return _password_hasher
+
+def hash_password(password):
+    return get_password_hasher().run(generate_password_hash, password)
+
+def verify_password(password_hash, password):
+    return get_password_hasher().run(check_password_hash, password_hash, password)
+
+# ====================================
+# 🌐 CLIENT HTTP CONDIVISI
+# ====================================
+
+class DefaultTimeout:
+    """Mixin per Session: timeout (connessione, lettura) di default se la chiamata non lo indica"""
+    
+    default_timeout = None
+    
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(method, url, *args, **kwargs)
+
+class PooledSession(DefaultTimeout, requests.Session):
+    pass
+
+_pooled_scraper_class = None
+
+def pooled_scraper():
+    """cloudscraper con timeout di default (classe creata al primo uso: cloudscraper è lazy)"""
+    global _pooled_scraper_class
+    if _pooled_scraper_class is None:
+        _pooled_scraper_class = type('PooledScraper', (DefaultTimeout, cloudscraper.CloudScraper), {})
+    return _pooled_scraper_class()
+
+class HTTPClients:
+    """
+    Client HTTP del processo: le connessioni TCP/TLS restano aperte (keep-alive)
+    e vengono riusate tra conversioni, analisi e thread.
+    - scraper(): un cloudscraper per thread (pagine catalogo): lo stato della
+      challenge (header, cookie, profondità) resta privato del thread, gli adapter
+      TLS di cloudscraper e i loro pool sono condivisi
+    - session(): Session leggera per chiamante (header propri) montata sugli
+      adapter condivisi, quindi sugli stessi pool di connessioni
+    Le Session condivise non vanno mai chiuse: chiuderebbero i pool di tutti.
+    """
+    
+    def __init__(self, pool_connections, pool_maxsize, host_pool_sizes=None, timeout=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.host_pool_sizes = host_pool_sizes or {}
+        self.timeout = timeout
+        self.adapters = self._sized_adapters(HTTPAdapter(), HTTPAdapter())
+        self.scraper_adapters = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+    
+    def _sized_adapters(self, http_adapter, https_adapter):
+        """Adapter per prefisso URL con le dimensioni di pool configurate (generali e per host)"""
+        adapters = {
+            'http://': self._resize(http_adapter, self.pool_connections, self.pool_maxsize),
+            'https://': self._resize(https_adapter, self.pool_connections, self.pool_maxsize)
+        }
+        for host, size in self.host_pool_sizes.items():
+            adapters[f'http://{host}'] = self._resize(copy(http_adapter), 1, size)
+            adapters[f'https://{host}'] = self._resize(copy(https_adapter), 1, size)
+        return adapters
+    
+    @staticmethod
+    def _resize(adapter, pool_connections, pool_maxsize):
+        adapter.init_poolmanager(pool_connections, pool_maxsize)
+        return adapter
+    
+    def scraper(self):
+        """cloudscraper del thread chiamante (creato al primo uso) sugli adapter TLS condivisi"""
+        scraper = getattr(self.local, 'scraper', None)
+        if scraper is None:
+            scraper = pooled_scraper()
+            scraper.default_timeout = self.timeout
+            with self.lock:
+                if self.scraper_adapters is None:
+                    self.scraper_adapters = self._sized_adapters(scraper.get_adapter('http://'),
+                                                                 scraper.get_adapter('https://'))
+            for prefix, adapter in self.scraper_adapters.items():
+                scraper.mount(prefix, adapter)
+            self.local.scraper = scraper
+        return scraper
+    
+    def session(self):
+        """Nuova Session sugli adapter (e quindi sui pool) condivisi"""
+        session = PooledSession()
+        session.default_timeout = self.timeout
+        for prefix, adapter in self.adapters.items():
+            session.mount(prefix, adapter)
+        return session
+    
+    def stats(self):
+        """Pool aperti, connessioni (aperte, create) e richieste servite; senza nomi di host"""
+        adapters = list(self.adapters.values())
+        with self.lock:
+            if self.scraper_adapters is not None:
+                adapters += list(self.scraper_adapters.values())
+        
+        pools = open_connections = connections = served = 0
+        for adapter in {id(a): a for a in adapters}.values():
+            manager = adapter.poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                idle = sum(1 for conn in list(pool.pool.queue) if getattr(conn, 'sock', None) is not None)
+                pools += 1
+                open_connections += idle + (pool.pool.maxsize - pool.pool.qsize())
+                connections += pool.num_connections
+                served += pool.num_requests
+        return {
+            'pools': pools,
+            'open_connections': open_connections,
+            'connections_created': connections,
+            'requests': served,
+            'reuse_ratio': round(1 - connections / served, 3) if served else 0,
+            'pool_maxsize': self.pool_maxsize
+        }
+
+_http_clients = None
+_http_clients_lock = threading.Lock()
+
+def get_http_clients():
+    """Registro client HTTP condiviso dal processo (creato al primo uso)"""
+    global _http_clients
+    with _http_clients_lock:
+        if _http_clients is None:
+            _http_clients = HTTPClients(
+                Config.HTTP_POOL_CONNECTIONS,
+                Config.HTTP_POOL_MAXSIZE,
+                Config.HTTP_HOST_POOL_SIZES,
+                (Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT)
+            )
+        return _http_clients
 
 # ====================================
 # 🧠 COMPETITOR INTELLIGENCE SYSTEM (L'AI)
 # ====================================
 
+def market_key(product_name, brand=None):
+    """Chiave cache analisi: hash di nome e brand normalizzati (il nome originale non viene salvato)"""
+    name = ' '.join((product_name or '').lower().split())
+    brand = ' '.join((brand or '').upper().split())
+    return hashlib.sha256(f"{brand}|{name}".encode()).hexdigest()
+
+class MarketAnalysisCache:
+    """
+    Memoizzazione di analyze_market: LRU in memoria per processo, persistita
+    nella tabella market_analyses (condivisa tra worker e riavvii).
+    Richieste simultanee della stessa chiave attendono un'unica analisi;
+    le scritture sul DB sono raggruppate in batch.
+    """
+    
+    def __init__(self, ttl, max_entries=10000, flush_rows=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_rows = flush_rows
+        self.entries = OrderedDict()  # chiave -> (scadenza, dati)
+        self.inflight = {}
+        self.pending = {}
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get_or_compute(self, key, compute, cacheable=None):
+        with self.lock:
+            data = self._get_memory(key)
+            if data is not None:
+                self.hits += 1
+                return data
+            waiting = self.inflight.get(key)
+            if waiting is None:
+                self.inflight[key] = Future()
+        if waiting is not None:
+            return waiting.result()
+        
+        future = self.inflight[key]
+        try:
+            data = self._load(key)
+            if data is not None:
+                with self.lock:
+                    self.db_hits += 1
+                    self._store_memory(key, data, time.time() + self.ttl)
+            else:
+                data = compute()
+                with self.lock:
+                    self.misses += 1
+                    if cacheable is None or cacheable(data):
+                        self.pending[key] = data
+                        self._store_memory(key, data, time.time() + self.ttl)
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+        
+        if len(self.pending) >= self.flush_rows:
+            self.flush()
+        return data
+    
+    def peek(self, key):
+        """Dati già in memoria (conta come hit), senza calcolare né leggere il DB"""
+        with self.lock:
+            data = self._get_memory(key)
+            if data is not None:
+                self.hits += 1
+            return data
+    
+    def _get_memory(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+    
+    def _store_memory(self, key, data, expires_at):
+        self.entries[key] = (expires_at, data)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def _load(self, key):
+        """Analisi salvata da un altro worker (o prima di un riavvio) ancora valida"""
+        if not has_app_context():
+            return None
+        try:
+            with DBSession(db.engine) as s:
+                row = s.query(MarketAnalysis).filter_by(cache_key=key).first()
+                if row and row.created_at >= datetime.now() - timedelta(seconds=self.ttl):
+                    return json.loads(row.data)
+        except Exception as e:
+            print(f"Errore cache analisi (lettura): {e}")
+        return None
+    
+    def flush(self):
+        """Scrive sul DB le analisi nuove in un'unica transazione ed elimina quelle scadute"""
+        if not has_app_context():
+            return
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            with DBSession(db.engine) as s:
+                now = datetime.now()
+                s.query(MarketAnalysis).filter(
+                    MarketAnalysis.created_at < now - timedelta(seconds=self.ttl)
+                ).delete(synchronize_session=False)
+                existing = {row.cache_key: row for row in
+                            s.query(MarketAnalysis).filter(MarketAnalysis.cache_key.in_(list(pending)))}
+                for key, data in pending.items():
+                    row = existing.get(key) or MarketAnalysis(cache_key=key)
+                    row.data = json.dumps(data)
+                    row.created_at = now
+                    s.add(row)
+                s.commit()
+        except Exception as e:
+            # Un altro worker ha salvato le stesse chiavi: restano valide le sue
+            print(f"Errore cache analisi (scrittura): {e}")
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.db_hits + self.misses
+            return {
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.db_hits) / lookups, 3) if lookups else 0,
+                'entries': len(self.entries),
+                'ttl': self.ttl
+            }
+
+_competitor_pool = None
+_competitor_pool_lock = threading.Lock()
+
+def get_competitor_pool():
+    """Pool condiviso per le ricerche parallele sui competitor"""
+    global _competitor_pool
+    with _competitor_pool_lock:
+        if _competitor_pool is None:
+            _competitor_pool = ThreadPoolExecutor(max_workers=Config.COMPETITOR_WORKERS,
+                                                  thread_name_prefix='luxlab-market')
+        return _competitor_pool
+
+_market_cache = None
+_market_cache_lock = threading.Lock()
+
+def get_market_cache():
+    """Cache analisi di mercato condivisa dal processo (creata al primo uso)"""
+    global _market_cache
+    with _market_cache_lock:
+        if _market_cache is None:
+            _market_cache = MarketAnalysisCache(Config.MARKET_CACHE_TTL, Config.MARKET_CACHE_MAX_ENTRIES)
+        return _market_cache
+
 class CompetitorIntelligence:
     """
     SISTEMA AI: CompetitorIntelligence
@@ -255,11 +1084,69 @@ class CompetitorIntelligence:
     QUESTA È L'INTELLIGENZA ARTIFICIALE DEL SISTEMA
     """
     
+    # Base margins per strategia
+    STRATEGY_MARGINS = {
+        'AGGRESSIVE': 0.30,
+        'BALANCED': 0.50,
+        'PREMIUM': 0.70,
+        'CUSTOM': 0.50
+    }
+    
     def __init__(self):
-        self.scraper = cloudscraper.create_scraper()
         self.ai_name = "CompetitorIntelligence AI v2.0"
     
     def analyze_market(self, product_name, brand=None):
+        """Analisi di mercato memoizzata per nome e brand normalizzati (TTL Config.MARKET_CACHE_TTL)"""
+        return get_market_cache().get_or_compute(
+            market_key(product_name, brand),
+            lambda: self._analyze_market(product_name, brand),
+            cacheable=lambda data: data['competitors']  # Nessun sito ha risposto: si riprova
+        )
+    
+    def analyze_market_batch(self, products):
+        """
+        Analisi di mercato per una lista di prodotti (risultati nello stesso ordine).
+        Ogni coppia nome/brand normalizzata viene analizzata una sola volta,
+        con al massimo Config.MARKET_BATCH_WORKERS analisi in parallelo.
+        """
+        cache = get_market_cache()
+        keys = []
+        unique = {}
+        for product in products:
+            name_brand = (product.get('original_name_hidden', product['Modello']), product['MACRO'])
+            key = market_key(*name_brand)
+            keys.append(key)
+            unique.setdefault(key, name_brand)
+        
+        results = {}
+        missing = {}
+        for key, name_brand in unique.items():
+            data = cache.peek(key)
+            if data is not None:
+                results[key] = data
+            else:
+                missing[key] = name_brand
+        
+        if len(missing) == 1:
+            key, name_brand = missing.popitem()
+            results[key] = self.analyze_market(*name_brand)
+        elif missing:
+            flask_app = current_app._get_current_object() if has_app_context() else None
+            
+            def analyze(name_brand):
+                # La cache legge/scrive il DB solo dentro un app context
+                with flask_app.app_context() if flask_app else nullcontext():
+                    return self.analyze_market(*name_brand)
+            
+            with ThreadPoolExecutor(max_workers=min(Config.MARKET_BATCH_WORKERS, len(missing)),
+                                    thread_name_prefix='luxlab-batch') as pool:
+                for key, data in zip(missing, pool.map(analyze, missing.values())):
+                    results[key] = data
+        
+        cache.flush()
+        return [results[key] for key in keys]
+    
+    def _analyze_market(self, product_name, brand=None):
         """
         ANALIZZA SEGRETAMENTE I COMPETITOR CON AI
         Questa funzione NON appare MAI nei file generati
@@ -275,10 +1162,22 @@ class CompetitorIntelligence:
             'confidence_score': 0
         }
         
-        # AI cerca su ogni competitor (NASCOSTO)
-        for comp_name, comp_url in Config.COMPETITOR_SITES.items():
+        # AI cerca su tutti i competitor in parallelo (NASCOSTO): entro COMPETITOR_DEADLINE
+        # valgono i siti che hanno risposto. Non c'è un timeout per sito: le ricerche in
+        # ritardo non vengono interrotte, finiscono nel pool e il loro risultato si scarta
+        pool = get_competitor_pool()
+        searches = {
+            comp_name: pool.submit(self._search_competitor, comp_url, product_name, brand)
+            for comp_name, comp_url in Config.COMPETITOR_SITES.items()
+        }
+        wait(searches.values(), timeout=Config.COMPETITOR_DEADLINE)
+        market_data['competitors_checked'] = len(searches)
+        
+        for comp_name, search in searches.items():
+            if not search.done():
+                continue
             try:
-                price = self._search_competitor(comp_url, product_name, brand)
+                price = search.result()
                 if price:
                     market_data['competitors'][comp_name] = price
                     market_data['min_price'] = min(market_data['min_price'], price)
@@ -360,11 +1259,12 @@ class CompetitorIntelligence:
             }
     
     def _calculate_confidence(self, market_data):
-        """AI calcola livello di confidenza analisi"""
-        num_competitors = len(market_data['competitors'])
-        if num_competitors >= 4:
+        """AI calcola livello di confidenza analisi (quota di competitor che hanno risposto)"""
+        checked = market_data.get('competitors_checked') or len(Config.COMPETITOR_SITES)
+        responded = len(market_data['competitors']) / checked
+        if responded >= 0.8:
             return 95
-        elif num_competitors >= 2:
+        elif responded >= 0.4:
             return 80
         else:
             return 65
@@ -378,14 +1278,7 @@ class CompetitorIntelligence:
         """
         
         # Base margins per strategia
-        margins = {
-            'AGGRESSIVE': 0.30,
-            'BALANCED': 0.50,
-            'PREMIUM': 0.70,
-            'CUSTOM': 0.50
-        }
-        
-        margin = margins.get(strategy, 0.50)
+        margin = self.STRATEGY_MARGINS.get(strategy, 0.50)
         
         # Se AI ha dati di mercato, aggiusta intelligentemente
         if market_data and market_data.get('avg_price'):
@@ -425,118 +1318,1060 @@ class CompetitorIntelligence:
             'market_position': 'competitive' if margin > 0.4 else 'aggressive',
             'ai_optimized': True
         }
+    
+    def calculate_smart_prices(self, original_prices, strategy='BALANCED', market_data=None):
+        """
+        calculate_smart_price per un intero catalogo, con risultati identici:
+        vettoriale con NumPy se installato. market_data è una lista allineata
+        ai prezzi (dati di mercato per prodotto, anche None) oppure None.
+        """
+        market_data = market_data or [None] * len(original_prices)
+        if not NUMPY_AVAILABLE:
+            return [self.calculate_smart_price(price, strategy, data)
+                    for price, data in zip(original_prices, market_data)]
+        
+        market_avg = [(data.get('avg_price') or 0) if data else 0 for data in market_data]
+        market_min = [data.get('min_price', price) if data else price
+                      for price, data in zip(original_prices, market_data)]
+        proposed, discount, margin = smart_price_arrays(original_prices, strategy, market_min, market_avg)
+        
+        return [
+            {
+                'retail': price,
+                'proposed': final_price,
+                'discount': product_discount,
+                'real_margin': product_margin * 100,
+                'market_position': 'competitive' if product_margin > 0.4 else 'aggressive',
+                'ai_optimized': True
+            }
+            for price, final_price, product_discount, product_margin in zip(
+                original_prices, proposed.astype(np.int64).tolist(),
+                discount.astype(np.int64).tolist(), margin.tolist())
+        ]
+
+def smart_price_arrays(original_prices, strategy='BALANCED', market_min=None, market_avg=None):
+    """
+    Motore prezzi vettoriale (NumPy): stessi passaggi in float64 di
+    calculate_smart_price, incluso l'arrotondamento half-even di round().
+    market_avg a 0 indica un prodotto senza dati di mercato.
+    Restituisce gli array (prezzo proposto, sconto %, margine).
+    """
+    retail = np.asarray(original_prices, dtype=np.float64)
+    margin = np.full(retail.shape, CompetitorIntelligence.STRATEGY_MARGINS.get(strategy, 0.50))
+    
+    if market_avg is not None:
+        avg_market = np.nan_to_num(np.asarray(market_avg, dtype=np.float64))
+        if strategy == 'AGGRESSIVE':
+            lowest = retail if market_min is None else np.asarray(market_min, dtype=np.float64)
+            target_price = lowest * 0.95
+        elif strategy == 'PREMIUM':
+            target_price = avg_market * 1.15
+        else:
+            target_price = avg_market * 0.98
+        with np.errstate(divide='ignore', invalid='ignore'):
+            market_margin = np.maximum(0.15, np.minimum(0.85, (retail - target_price) / retail))
+        margin = np.where(avg_market != 0, market_margin, margin)
+    
+    final_price = retail * (1 - margin)
+    
+    # Arrotonda professionalmente
+    final_price = np.where(final_price > 1000, np.round(final_price / 10) * 10,
+                           np.where(final_price > 100, np.round(final_price / 5) * 5, np.round(final_price)))
+    discount = np.round((1 - final_price / retail) * 100)
+    return final_price, discount, margin
 
 # ====================================
-# 🕷️ ESTRATTORE STEALTH UNIVERSALE
+# 🖼️ PIPELINE IMMAGINI HD
 # ====================================
 
-class StealthExtractor:
-    """Estrattore universale con supporto immagini HD"""
+class ImageProcessor:
+    """
+    Elaborazione immagini HD riutilizzabile (una istanza per processo):
+    - decode JPEG in modalità draft, già vicino alla dimensione finale
+    - watermark LUXLAB renderizzato una volta come maschera alpha
+    - impostazioni encoder JPEG configurabili
+    """
     
-    def __init__(self, include_images=False):
-        self.scraper = cloudscraper.create_scraper()
-        self.include_images = include_images
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': ua.random,
-            'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        })
+    def __init__(self, size=800, quality=95, optimize=True, progressive=False,
+                 watermark='LUXLAB', watermark_opacity=128, reducing_gap=2.0):
+        self.size = size
+        self.quality = quality
+        self.optimize = optimize
+        self.progressive = progressive
+        self.watermark = watermark
+        self.watermark_opacity = watermark_opacity
+        self.reducing_gap = reducing_gap
+        self.watermark_mask = self._render_watermark() if watermark else None
     
-    def extract_products(self, url, max_products=500):
-        """Estrae prodotti SENZA MAI salvare riferimenti alla fonte"""
-        products = []
-        
+    def _render_watermark(self):
+        """Maschera alpha del testo, da comporre con un solo paste"""
         try:
-            # Delay anti-bot
-            time.sleep(random.uniform(Config.MIN_DELAY, Config.MAX_DELAY))
-            
-            # Usa cloudscraper per bypassare protezioni
-            response = self.scraper.get(url, timeout=30)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Selettori universali per prodotti luxury
-            selectors = [
-                'article[class*="product"]',
-                'div[class*="product-item"]',
-                'div[class*="product-card"]',
-                'li[class*="product"]',
-                '[data-test*="product"]',
-                'div[class*="item"][class*="grid"]',
-                'div[data-product]',
-                '[itemtype*="schema.org/Product"]'
-            ]
-            
-            items = []
-            for selector in selectors:
-                items = soup.select(selector)[:max_products]
-                if items:
-                    break
-            
-            # Se non trova con selettori, prova con link
-            if not items:
-                items = soup.find_all('a', href=True)
-                items = [item for item in items if 'product' in item.get('href', '').lower()][:max_products]
-            
-            # Parsing intelligente
-            for idx, item in enumerate(items, 1):
-                product = self._parse_luxury_item(item, idx)
-                if product:
-                    products.append(product)
-            
-            return products
-            
-        except Exception as e:
-            print(f"Errore estrazione: {e}")
-            return products
-    
-    def _parse_luxury_item(self, element, idx):
-        """Parse prodotto luxury con anonimizzazione completa"""
-        
-        # Genera SKU interno (MAI usare quello originale)
-        sku = f"LXB{datetime.now().strftime('%y%m')}{idx:04d}"
-        
-        # Estrai info base
-        nome = self._extract_text(element, ['h1', 'h2', 'h3', '[class*="name"]', '[class*="title"]'])
-        if not nome:
-            nome = f"Luxury Item {idx}"
+            font = ImageFont.truetype("arial.ttf", 20)
+        except:
+            font = ImageFont.load_default()
         
-        # Brand detection
-        brand = self._detect_brand(nome, element)
+        bbox = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), self.watermark, font=font)
+        mask = Image.new('L', (bbox[2] - bbox[0], bbox[3] - bbox[1]), 0)
+        ImageDraw.Draw(mask).text((-bbox[0], -bbox[1]), self.watermark, fill=self.watermark_opacity, font=font)
+        return mask
+    
+    def params(self):
+        """Parametri che determinano i bytes prodotti (chiave della cache su disco)"""
+        return {
+            'size': self.size,
+            'quality': self.quality,
+            'optimize': self.optimize,
+            'progressive': self.progressive,
+            'watermark': self.watermark,
+            'watermark_opacity': self.watermark_opacity,
+            'reducing_gap': self.reducing_gap
+        }
+    
+    def process(self, content):
+        """Elabora immagine HD: RGB, resize, watermark LUXLAB, JPEG"""
+        img = Image.open(BytesIO(content))
         
-        # Prezzo
-        prezzo = self._extract_price(element)
-        if not prezzo:
-            prezzo = random.randint(500, 3000)
+        # JPEG: il decoder scala già in DCT fino alla dimensione più vicina al target
+        if img.format == 'JPEG':
+            img.draft('RGB', (self.size, self.size))
         
-        # Categoria e genere
-        categoria = self._detect_category(nome, element)
-        gender = self._detect_gender(nome, element)
+        # Converti in RGB
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
         
-        # Immagine (solo se richiesta)
-        img_data = None
-        if self.include_images:
-            img_url = self._extract_image(element)
-            if img_url:
-                img_data = self._download_and_process_image(img_url, idx)
+        # Ridimensiona a HD mantenendo aspect ratio
+        img.thumbnail((self.size, self.size), Image.Resampling.LANCZOS, reducing_gap=self.reducing_gap)
         
-        # Taglie disponibili
-        taglie = self._generate_sizes(categoria)
+        # Watermark semi-trasparente in basso a destra
+        if self.watermark_mask:
+            x = max(0, img.width - self.watermark_mask.width - 10)
+            y = max(0, img.height - self.watermark_mask.height - 10)
+            img.paste((255, 255, 255), (x, y), self.watermark_mask)
         
-        return {
-            'STG': sku,
-            'MACRO': brand,
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=self.quality, optimize=self.optimize,
+                 progressive=self.progressive)
+        return output.getvalue()
+
+_image_processor = None
+
+def get_image_processor():
+    """ImageProcessor del processo corrente (creato al primo uso, anche nei worker del pool processi)"""
+    global _image_processor
+    if _image_processor is None:
+        _image_processor = ImageProcessor(
+            size=Config.IMAGE_MAX_SIZE,
+            quality=Config.IMAGE_QUALITY,
+            optimize=Config.IMAGE_OPTIMIZE,
+            progressive=Config.IMAGE_PROGRESSIVE,
+            watermark=Config.IMAGE_WATERMARK,
+            watermark_opacity=Config.IMAGE_WATERMARK_OPACITY
+        )
+    return _image_processor
+
+def process_product_image(content):
+    """Elabora immagine HD con l'ImageProcessor condiviso"""
+    return get_image_processor().process(content)
+
+def process_product_image_timed(content):
+    """process_product_image con la durata misurata dove gira (thread o processo del pool)"""
+    start = time.perf_counter()
+    data = process_product_image(content)
+    return data, time.perf_counter() - start
+
+class ImageCache:
+    """
+    Cache su disco delle immagini già elaborate (bytes JPEG finali).
+    Chiave: URL + hash dei parametri di elaborazione. Scritture atomiche
+    (file temporaneo + rename) quindi sicura tra più worker gunicorn;
+    eviction LRU sulla data di ultimo accesso quando si supera il tetto.
+    """
+    
+    def __init__(self, path, max_bytes, params):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self._written = max_bytes  # Forza un controllo del tetto alla prima scrittura
+        os.makedirs(path, exist_ok=True)
+    
+    def _file(self, url):
+        key = hashlib.sha256(f"{url}|{self.params_hash}".encode()).hexdigest()
+        return os.path.join(self.path, key[:2], key + '.jpg')
+    
+    def get(self, url):
+        """Bytes in cache per l'URL, o None"""
+        filepath = self._file(url)
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            os.utime(filepath)  # Aggiorna l'ordine LRU
+        except OSError:
+            data = None
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+    
+    def put(self, url, data):
+        """Salva i bytes in modo atomico"""
+        filepath = self._file(url)
+        directory = os.path.dirname(filepath)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, filepath)
+        except OSError as e:
+            print(f"Errore cache immagini: {e}")
+            return
+        
+        with self.lock:
+            self._written += len(data)
+            check = self._written >= self.max_bytes // 10
+            if check:
+                self._written = 0
+        if check:
+            self.enforce_limit()
+    
+    def enforce_limit(self):
+        """Elimina i file usati meno di recente finché si torna sotto il 90% del tetto"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                filepath = os.path.join(root, name)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+                total += st.st_size
+        
+        if total <= self.max_bytes:
+            return
+        
+        target = self.max_bytes * 0.9
+        for _, size, filepath in sorted(entries):
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue  # Già rimosso da un altro worker
+            total -= size
+            with self.lock:
+                self.evicted += 1
+            if total <= target:
+                break
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'evicted': self.evicted,
+                'max_mb': self.max_bytes // (1024 * 1024)
+            }
+
+class ImageBlob:
+    """Riferimento leggero a un'immagine elaborata su disco (al posto dei bytes nel prodotto)"""
+    
+    __slots__ = ('path', 'size')
+    
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+    
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+class BlobStore:
+    """
+    Directory temporanea con le immagini di una conversione:
+    i prodotti tengono solo un ImageBlob e i bytes vengono letti
+    quando il writer Excel li incorpora
+    """
+    
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='blobs-', dir=root)
+        self._counter = itertools.count()
+    
+    def put(self, data):
+        filepath = os.path.join(self.path, f"{next(self._counter):06d}.jpg")
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        return ImageBlob(filepath, len(data))
+    
+    def close(self):
+        """Elimina tutte le immagini della conversione"""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class ImagePipeline:
+    """
+    Download ed elaborazione immagini in parallelo e con limiti:
+    - pool I/O per i download, con concorrenza massima per host
+    - pool separato (thread o processi) per decode/resize/encode PIL
+    """
+    
+    def __init__(self, download_workers, process_workers, process_mode='thread',
+                 host_limits=None, default_host_limit=4, cache=None):
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='luxlab-img-io')
+        if process_mode == 'process':
+            self.process_pool = ProcessPoolExecutor(max_workers=process_workers)
+        else:
+            self.process_pool = ThreadPoolExecutor(max_workers=process_workers, thread_name_prefix='luxlab-img-cpu')
+        self.host_limits = host_limits or {}
+        self.default_host_limit = default_host_limit
+        self.cache = cache
+        self.host_slots = {}
+        self.lock = threading.Lock()
+    
+    def submit(self, session, img_url, store=None):
+        """
+        Restituisce un Future con i bytes JPEG elaborati (None se fallisce).
+        Con uno store i bytes vengono scritti su disco appena pronti
+        e il Future contiene un ImageBlob.
+        """
+        result = Future()
+        download = self.download_pool.submit(self._fetch, session, img_url)
+        download.add_done_callback(lambda f: self._on_downloaded(f, img_url, result, store))
+        return result
+    
+    def _host_slot(self, img_url):
+        """Semaforo che limita i download simultanei verso lo stesso host"""
+        host = urlparse(img_url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                limit = self.host_limits.get(host, self.default_host_limit)
+                self.host_slots[host] = threading.BoundedSemaphore(limit)
+            return self.host_slots[host]
+    
+    def _fetch(self, session, img_url):
+        """Bytes già elaborati dalla cache, oppure il sorgente scaricato"""
+        if self.cache:
+            cached = self.cache.get(img_url)
+            if cached:
+                return cached, True
+        
+        with self._host_slot(img_url):
+            with stage_seconds.time(stage='image_download'):
+                response = session.get(img_url, timeout=(Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_IMAGE_READ_TIMEOUT))
+        fetched_bytes.inc(len(response.content), kind='image')
+        if response.status_code == 200:
+            return response.content, False
+        return None, False
+    
+    def _on_downloaded(self, download, img_url, result, store):
+        try:
+            content, cached = download.result()
+            if not content or cached:
+                images_processed.inc(result='cached' if content else 'failed')
+                self._finish(result, content, store)
+                return
+            process = self.process_pool.submit(process_product_image_timed, content)
+            process.add_done_callback(lambda f: self._on_processed(f, img_url, result, store))
+        except Exception:
+            images_processed.inc(result='failed')
+            result.set_result(None)
+    
+    def _on_processed(self, process, img_url, result, store):
+        try:
+            data, seconds = process.result()
+            stage_seconds.observe(seconds, stage='image_process')
+        except Exception:
+            data = None
+        images_processed.inc(result='processed' if data else 'failed')
+        if data and self.cache:
+            self.cache.put(img_url, data)
+        self._finish(result, data, store)
+    
+    def _finish(self, result, data, store):
+        """Consegna il risultato, spostando i bytes nello store se presente"""
+        if data and store:
+            try:
+                data = store.put(data)
+            except OSError as e:
+                print(f"Errore blob store: {e}")
+                data = None
+        result.set_result(data)
+
+_image_pipeline = None
+_image_pipeline_lock = threading.Lock()
+
+def get_image_pipeline():
+    """Pipeline immagini condivisa dal processo (creata al primo uso)"""
+    global _image_pipeline
+    with _image_pipeline_lock:
+        if _image_pipeline is None:
+            _image_pipeline = ImagePipeline(
+                Config.IMAGE_DOWNLOAD_WORKERS,
+                Config.IMAGE_PROCESS_WORKERS,
+                Config.IMAGE_PROCESS_MODE,
+                Config.IMAGE_HOST_CONCURRENCY,
+                Config.IMAGE_HOST_DEFAULT_CONCURRENCY,
+                ImageCache(Config.IMAGE_CACHE_PATH, Config.IMAGE_CACHE_MAX_MB * 1024 * 1024, get_image_processor().params())
+            )
+        return _image_pipeline
+
+# ====================================
+# 🏷️ CLASSIFICAZIONE PRODOTTI
+# ====================================
+
+LUXURY_BRANDS = [
+    'GUCCI', 'PRADA', 'VALENTINO', 'VERSACE', 'FENDI',
+    'DOLCE&GABBANA', 'BALENCIAGA', 'GIVENCHY', 'SAINT LAURENT',
+    'BOTTEGA VENETA', 'BURBERRY', 'CELINE', 'LOEWE', 'MARNI'
+]
+
+# Famiglie di keyword in ordine di priorità: (etichetta, keyword)
+CATEGORY_KEYWORDS = [
+    ('BAGS', ['bag', 'borsa', 'clutch', 'tote', 'shoulder']),
+    ('SHOES', ['shoe', 'sneaker', 'boot', 'sandal', 'pump', 'loafer']),
+    ('READY-TO-WEAR', ['dress', 'shirt', 'jacket', 'coat', 'trouser', 'skirt']),
+    ('ACCESSORIES', ['belt', 'wallet', 'scarf', 'hat', 'jewelry', 'watch']),
+    ('SMALL LEATHER', ['wallet', 'card', 'key', 'pouch'])
+]
+
+GENDER_KEYWORDS = [
+    ('F', ['woman', 'women', 'donna', 'female', 'ladies', 'girl']),
+    ('M', ['man', 'men', 'uomo', 'male', 'mens', 'boy'])
+]
+
+COLOR_KEYWORDS = [
+    ('NERO', ['black']), ('BIANCO', ['white']), ('ROSSO', ['red']),
+    ('BLU', ['blue']), ('VERDE', ['green']), ('MARRONE', ['brown']),
+    ('GRIGIO', ['grey']), ('BEIGE', ['beige']), ('ROSA', ['pink'])
+]
+
+class KeywordClassifier:
+    """
+    Classificatore a passata singola su più famiglie di keyword.
+    Una regex precompilata con lookahead trova in ogni posizione la keyword
+    più lunga; ogni keyword eredita le etichette delle keyword che ne sono
+    prefisso. Per ogni famiglia vince l'etichetta con priorità più alta,
+    esattamente come i controlli `kw in nome` fatti in ordine.
+    """
+    
+    def __init__(self, families):
+        labels = {}
+        for family, groups in families.items():
+            for priority, (label, keywords) in enumerate(groups):
+                for kw in keywords:
+                    found = labels.setdefault(kw, {})
+                    if family not in found or priority < found[family][0]:
+                        found[family] = (priority, label)
+        
+        # Se combacia una keyword, combaciano anche tutte quelle che ne sono prefisso
+        self.matches = {}
+        for kw in labels:
+            merged = {}
+            for other, found in labels.items():
+                if kw.startswith(other):
+                    for family, (priority, label) in found.items():
+                        if family not in merged or priority < merged[family][0]:
+                            merged[family] = (priority, label)
+            self.matches[kw] = merged
+        
+        self.families = list(families)
+        self.pattern = re.compile('(?=(' + self._trie_regex(labels) + '))')
+    
+    @staticmethod
+    def _trie_regex(keywords):
+        """Regex a trie (prefissi comuni fattorizzati, match più lungo per primo)"""
+        trie = {}
+        for kw in keywords:
+            node = trie
+            for char in kw:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ''
+            pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+            if '' in node:
+                pattern = '(?:' + pattern + ')?'
+            return pattern
+        
+        return build(trie)
+    
+    def classify(self, text):
+        """Etichetta per famiglia (None se nessuna keyword presente)"""
+        best = {}
+        for keyword in self.pattern.findall(text):
+            for family, (priority, label) in self.matches[keyword].items():
+                if family not in best or priority < best[family][0]:
+                    best[family] = (priority, label)
+        return {family: best[family][1] if family in best else None for family in self.families}
+
+# I brand si cercano sul nome maiuscolo: per testo ASCII equivale a cercarli
+# in minuscolo nella stessa passata degli altri attributi
+BRAND_CLASSIFIER = KeywordClassifier({'brand': [(brand, [brand]) for brand in LUXURY_BRANDS]})
+PRODUCT_CLASSIFIER = KeywordClassifier({
+    'brand': [(brand, [brand.lower()]) for brand in LUXURY_BRANDS],
+    'category': CATEGORY_KEYWORDS,
+    'gender': GENDER_KEYWORDS,
+    'color': COLOR_KEYWORDS
+})
+
+def classify_product_name(nome):
+    """Brand, categoria, genere e colore dal nome prodotto (None dove non riconosciuti)"""
+    tags = PRODUCT_CLASSIFIER.classify(nome.lower())
+    if not nome.isascii():
+        tags['brand'] = BRAND_CLASSIFIER.classify(nome.upper())['brand']
+    return tags
+
+# Prezzo: una regex multi-valuta; il gruppo che combacia indica il formato (in ordine di priorità)
+PRICE_PATTERN = re.compile(
+    r'(?=€\s*(\d+(?:[.,]\d+)?)'
+    r'|(\d+(?:[.,]\d+)?)\s*€'
+    r'|EUR\s*(\d+(?:[.,]\d+)?)'
+    r'|\$\s*(\d+(?:[.,]\d+)?)'
+    r'|£\s*(\d+(?:[.,]\d+)?))'
+)
+
+def parse_price(text):
+    """Prezzo in EUR dal testo, o None"""
+    best = None
+    for match in PRICE_PATTERN.finditer(text):
+        if best is None or match.lastindex < best.lastindex:
+            best = match
+            if best.lastindex == 1:
+                break
+    if best is None:
+        return None
+    
+    price = float(best.group(best.lastindex).replace(',', '.'))
+    # Conversione valute
+    if '$' in text:
+        price *= 0.92  # USD to EUR
+    elif '£' in text:
+        price *= 1.16  # GBP to EUR
+    return price
+
+# ====================================
+# 🕷️ ESTRATTORE STEALTH UNIVERSALE
+# ====================================
+
+def html_parser_backend(preferred='auto'):
+    """Parser BeautifulSoup da usare: il più veloce installato se 'auto'"""
+    if preferred != 'auto':
+        return preferred
+    for name in ('lxml', 'html.parser'):
+        if builder_registry.lookup(name):
+            return name
+    return 'html.parser'
+
+def is_product_container(name, attrs=None):
+    """
+    Filtro per il parsing mirato (SoupStrainer): True per i tag che
+    StealthExtractor.PRODUCT_SELECTORS o il fallback sui link possono
+    selezionare. Viene costruito solo il loro sottoalbero.
+    """
+    if attrs is None:  # Chiamato con un Tag già costruito
+        name, attrs = name.name, name.attrs
+    
+    classes = attrs.get('class', '')
+    if isinstance(classes, list):
+        classes = ' '.join(classes)
+    
+    if 'product' in classes and name in ('article', 'li'):
+        return True
+    if name == 'div' and ('product-item' in classes or 'product-card' in classes
+                          or ('item' in classes and 'grid' in classes) or 'data-product' in attrs):
+        return True
+    if 'product' in attrs.get('data-test', '') or 'schema.org/Product' in attrs.get('itemtype', ''):
+        return True
+    return name == 'a' and 'product' in attrs.get('href', '').lower()
+
+# Paginazione: link rel="next" oppure numero di pagina in query (?page=N) o nel percorso (/page/N)
+PAGE_PARAMS = ('page', 'pagina', 'pg', 'p')
+LINK_TAG_PATTERN = re.compile(r'<(?:a|link)\b[^>]*>', re.IGNORECASE)
+HREF_PATTERN = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.IGNORECASE)
+REL_NEXT_PATTERN = re.compile(r'\brel\s*=\s*["\']?[^"\'>]*\bnext\b', re.IGNORECASE)
+PATH_PAGE_PATTERN = re.compile(r'/page/(\d+)(/?)$')
+
+def page_number(url):
+    """(parametro, numero) della pagina indicata nell'URL; (None, None) se assente"""
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    for param in PAGE_PARAMS:
+        if query.get(param, '').isdigit():
+            return param, int(query[param])
+    match = PATH_PAGE_PATTERN.search(parsed.path)
+    if match:
+        return '/page/', int(match.group(1))
+    return None, None
+
+def with_page_number(url, param, number):
+    """Stesso URL con un altro numero di pagina"""
+    parsed = urlparse(url)
+    if param == '/page/':
+        return parsed._replace(path=PATH_PAGE_PATTERN.sub(rf'/page/{number}\2', parsed.path)).geturl()
+    query = [(k, str(number) if k == param else v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)]
+    return parsed._replace(query=urlencode(query)).geturl()
+
+def listing_key(url):
+    """Host e percorso della lista, senza il numero di pagina"""
+    parsed = urlparse(url)
+    return parsed.netloc, PATH_PAGE_PATTERN.sub('', parsed.path).rstrip('/')
+
+def find_next_page(html, page_url):
+    """
+    URL della pagina successiva del catalogo: il link rel="next" se presente,
+    altrimenti un link alla stessa lista con numero di pagina successivo.
+    Lavora sull'HTML grezzo perché il parsing mirato scarta la paginazione.
+    """
+    current = listing_key(page_url)
+    param, number = page_number(page_url)
+    expected = (number or 1) + 1
+    
+    candidate = None
+    for tag in LINK_TAG_PATTERN.findall(html):
+        href = HREF_PATTERN.search(tag)
+        if not href:
+            continue
+        link = urljoin(page_url, unescape(next(g for g in href.groups() if g is not None)))
+        if REL_NEXT_PATTERN.search(tag):
+            return link
+        if candidate is None:
+            link_param, link_number = page_number(link)
+            if link_number == expected and (param is None or link_param == param) and listing_key(link) == current:
+                candidate = link
+    return candidate
+
+class RobotsPolicy:
+    """Regole robots.txt per origine, scaricate al primo uso e tenute per un TTL"""
+    
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.rules = {}
+        self.lock = threading.Lock()
+    
+    def allowed(self, session, url):
+        parsed = urlparse(url)
+        origin = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            entry = self.rules.get(origin)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            entry = (time.monotonic(), self._load(session, origin))
+            with self.lock:
+                self.rules[origin] = entry
+        return entry[1].can_fetch(session.headers.get('User-Agent', '*'), url)
+    
+    def _load(self, session, origin):
+        parser = RobotFileParser(origin + '/robots.txt')
+        try:
+            response = session.get(parser.url)
+            if response.status_code in (401, 403):
+                parser.disallow_all = True
+            elif response.status_code >= 400:
+                parser.allow_all = True
+            else:
+                parser.parse(response.text.splitlines())
+        except Exception:
+            parser.allow_all = True  # robots.txt irraggiungibile: nessuna restrizione nota
+        return parser
+
+class HostThrottle:
+    """Concorrenza massima e intervallo minimo (con jitter anti-bot) tra richieste allo stesso host"""
+    
+    def __init__(self, limit, min_delay, max_delay):
+        self.limit = limit
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.host_slots = {}
+        self.next_at = {}
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.limit)
+            semaphore = self.host_slots[host]
+        with semaphore:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, self.next_at.get(host, now))
+                self.next_at[host] = start + random.uniform(self.min_delay, self.max_delay)
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+class CachedPage:
+    """Pagina scaricata: corpo e validatori per le richieste condizionali"""
+    
+    __slots__ = ('text', 'status_code', 'etag', 'last_modified', 'size', 'fetched_at')
+    
+    def __init__(self, text, status_code=200, etag=None, last_modified=None, size=0):
+        self.text = text
+        self.status_code = status_code
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.fetched_at = time.monotonic()
+    
+    def validators(self):
+        """Header per la rivalidazione (vuoto se il server non ne ha forniti)"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+class PageCache:
+    """
+    Cache in memoria delle pagine di catalogo per URL normalizzato, condivisa
+    tra analisi e conversione. Entro il TTL la pagina si riusa senza rete;
+    poi, se ha ETag/Last-Modified, si rivalida (304 = corpo invariato).
+    """
+    
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def key(url):
+        """URL normalizzato: schema/host minuscoli, senza porta di default, frammento e parametri utm_"""
+        parsed = urlparse(url.strip())
+        scheme = parsed.scheme.lower()
+        host = (parsed.hostname or '').lower()
+        if parsed.port and parsed.port != {'http': 80, 'https': 443}.get(scheme):
+            host = f"{host}:{parsed.port}"
+        query = sorted((k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+                       if not k.lower().startswith('utm_'))
+        return f"{scheme}://{host}{parsed.path or '/'}" + (f"?{urlencode(query)}" if query else '')
+    
+    def lookup(self, url):
+        """(pagina, fresca): la pagina può essere scaduta ma ancora rivalidabile"""
+        key = self.key(url)
+        with self.lock:
+            page = self.entries.get(key)
+            if page is None:
+                return None, False
+            self.entries.move_to_end(key)
+            if time.monotonic() - page.fetched_at <= self.ttl:
+                self.hits += 1
+                return page, True
+            if not page.validators():
+                self._remove(key)
+                return None, False
+            return page, False
+    
+    def put(self, url, page):
+        key = self.key(url)
+        with self.lock:
+            self.misses += 1
+            if page.status_code != 200 or page.size > self.max_bytes:
+                return
+            self._remove(key)
+            self.entries[key] = page
+            self.size += page.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evicted += 1
+    
+    def refresh(self, page):
+        """Il server ha risposto 304: la copia in cache torna fresca"""
+        with self.lock:
+            self.revalidated += 1
+            page.fetched_at = time.monotonic()
+        return page
+    
+    def _remove(self, key):
+        page = self.entries.pop(key, None)
+        if page is not None:
+            self.size -= page.size
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.revalidated + self.misses
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.revalidated) / lookups, 3) if lookups else 0,
+                'entries': len(self.entries),
+                'evicted': self.evicted,
+                'max_mb': self.max_bytes // (1024 * 1024)
+            }
+
+class PageFetcher:
+    """Pool condiviso per le pagine di catalogo: robots.txt, cache, limiti per host e rate limit"""
+    
+    def __init__(self, workers, host_limit, min_delay, max_delay, respect_robots=True, robots_ttl=3600,
+                 cache=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='luxlab-page')
+        self.throttle = HostThrottle(host_limit, min_delay, max_delay)
+        self.robots = RobotsPolicy(robots_ttl) if respect_robots else None
+        self.cache = cache
+    
+    def submit(self, url):
+        """Future con la pagina (CachedPage; None se esclusa da robots.txt)"""
+        return self.pool.submit(self._fetch, url)
+    
+    def _fetch(self, url):
+        session = get_http_clients().scraper()  # cloudscraper del thread del pool
+        if self.robots and not self.robots.allowed(session, url):
+            print(f"Pagina esclusa da robots.txt: {url}")
+            return None
+        
+        cached, fresh = self.cache.lookup(url) if self.cache else (None, False)
+        if fresh:
+            pages_fetched.inc(source='cache')
+            return cached
+        
+        with self.throttle.slot(url):
+            with stage_seconds.time(stage='page_fetch'):
+                response = session.get(url, headers=cached.validators() if cached else None)
+        if cached and response.status_code == 304:
+            pages_fetched.inc(source='revalidated')
+            return self.cache.refresh(cached)
+        
+        page = CachedPage(response.text, response.status_code, response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'), len(response.content))
+        pages_fetched.inc(source='network')
+        fetched_bytes.inc(page.size, kind='page')
+        if self.cache:
+            self.cache.put(url, page)
+        return page
+
+_page_fetcher = None
+_page_fetcher_lock = threading.Lock()
+
+def get_page_fetcher():
+    """Fetcher pagine condiviso dal processo (creato al primo uso)"""
+    global _page_fetcher
+    with _page_fetcher_lock:
+        if _page_fetcher is None:
+            _page_fetcher = PageFetcher(
+                Config.CRAWL_WORKERS,
+                Config.CRAWL_HOST_CONCURRENCY,
+                Config.MIN_DELAY,
+                Config.MAX_DELAY,
+                Config.CRAWL_RESPECT_ROBOTS,
+                Config.CRAWL_ROBOTS_TTL,
+                PageCache(Config.PAGE_CACHE_TTL, Config.PAGE_CACHE_MAX_MB * 1024 * 1024)
+            )
+        return _page_fetcher
+
+class StealthExtractor:
+    """Estrattore universale con supporto immagini HD"""
+    
+    # Taglie disponibili per categoria
+    SIZE_MAPS = {
+        'BAGS': ['UNI'],
+        'SHOES': ['35', '36', '37', '38', '39', '40', '41', '42'],
+        'READY-TO-WEAR': ['XS', 'S', 'M', 'L', 'XL'],
+        'ACCESSORIES': ['70', '75', '80', '85', '90', '95', '100', '105'],
+        'SMALL LEATHER': ['UNI']
+    }
+    
+    # Selettori universali per prodotti luxury (in ordine di priorità)
+    PRODUCT_SELECTORS = [
+        'article[class*="product"]',
+        'div[class*="product-item"]',
+        'div[class*="product-card"]',
+        'li[class*="product"]',
+        '[data-test*="product"]',
+        'div[class*="item"][class*="grid"]',
+        'div[data-product]',
+        '[itemtype*="schema.org/Product"]'
+    ]
+    
+    def __init__(self, include_images=False, parser=None, targeted_parse=None):
+        self.include_images = include_images
+        self.parser = html_parser_backend(parser or Config.HTML_PARSER)
+        self.targeted_parse = Config.HTML_TARGETED_PARSE if targeted_parse is None else targeted_parse
+        self.blob_store = BlobStore(Config.IMAGE_BLOB_PATH) if include_images else None
+        self.session = get_http_clients().session()
+        self.session.headers.update({
+            'User-Agent': get_user_agents().random,
+            'Accept-Language': 'it-IT,it;q=0.9,en;q=0.8',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'DNT': '1',
+            'Connection': 'keep-alive',
+            'Upgrade-Insecure-Requests': '1'
+        })
+    
+    def extract_products(self, url, max_products=500, progress=None):
+        """Estrae prodotti SENZA MAI salvare riferimenti alla fonte"""
+        return list(self.iter_products(url, max_products, progress))
+    
+    def iter_products(self, url, max_products=500, progress=None):
+        """
+        Genera i prodotti pagina per pagina seguendo la paginazione del catalogo.
+        La pagina successiva viene richiesta prima di elaborare quella corrente
+        (più pagine in anticipo se numerate) e ci si ferma a max_products.
+        """
+        fetcher = get_page_fetcher()
+        pending = deque()
+        requested = set()
+        count = 0
+        
+        def request_page(page_url):
+            key = PageCache.key(page_url)
+            if key not in requested and len(requested) < Config.CRAWL_MAX_PAGES:
+                requested.add(key)
+                pending.append((page_url, fetcher.submit(page_url)))
+        
+        request_page(url)
+        try:
+            while pending and count < max_products:
+                page_url, future = pending.popleft()
+                with track_stage(progress, 'fetch'):
+                    page = future.result()
+                if page is None:
+                    break
+                if progress:
+                    progress.advance('fetched')
+                
+                with track_stage(progress, 'parse'):
+                    items = self._find_items(page.text, max_products - count)
+                    if not items:
+                        break
+                    if count + len(items) < max_products:
+                        self._request_next_pages(page.text, page_url, max_products - count - len(items),
+                                                 len(items), request_page)
+                if progress:
+                    progress.advance('items_found', len(items))
+                
+                # Parsing intelligente: le immagini partono subito nella pipeline parallela
+                products = []
+                pending_images = []
+                for item in items:
+                    with track_stage(progress, 'parse_item'):
+                        product = self._parse_luxury_item(item, count + len(products) + 1)
+                        img_url = self._extract_image(item) if product and self.include_images else None
+                    if product:
+                        products.append(product)
+                        if progress:
+                            progress.advance('parsed')
+                        if img_url:
+                            pending_images.append((product, self._submit_image(urljoin(page_url, img_url), progress)))
+                
+                # Ricongiunge le immagini ai prodotti nell'ordine originale
+                with track_stage(progress, 'images'):
+                    for product, future in pending_images:
+                        product['Foto'] = future.result()
+                
+                count += len(products)
+                yield from products
+            
+        except Exception as e:
+            print(f"Errore estrazione: {e}")
+        finally:
+            for _, future in pending:
+                future.cancel()
+    
+    def _request_next_pages(self, html, page_url, missing, per_page, request_page):
+        """Accoda la pagina successiva e, se numerata, quelle che servono a completare la quota"""
+        next_url = find_next_page(html, page_url)
+        if not next_url:
+            return
+        request_page(next_url)
+        
+        param, number = page_number(next_url)
+        if number is not None:
+            pages_needed = -(-missing // per_page)
+            for ahead in range(1, min(pages_needed, Config.CRAWL_PREFETCH_PAGES)):
+                request_page(with_page_number(next_url, param, number + ahead))
+    
+    def _submit_image(self, img_url, progress=None):
+        """Accoda download ed elaborazione di un'immagine HD"""
+        future = get_image_pipeline().submit(self.session, img_url, self.blob_store)
+        if progress:
+            progress.advance('images_total')
+            future.add_done_callback(lambda f: progress.advance('images_done'))
+        return future
+    
+    def close(self):
+        """Libera le immagini su disco (dopo che l'Excel è stato salvato)"""
+        if self.blob_store:
+            self.blob_store.close()
+    
+    def parse_html(self, html):
+        """Costruisce l'albero; in modalità mirata solo i sottoalberi dei contenitori prodotto"""
+        parse_only = None
+        if self.targeted_parse and self.parser != 'html5lib':  # html5lib non supporta parse_only
+            parse_only = SoupStrainer(is_product_container)
+        return BeautifulSoup(html, self.parser, parse_only=parse_only)
+    
+    def _find_items(self, html, max_products):
+        """Individua i contenitori prodotto nella pagina"""
+        soup = self.parse_html(html)
+        
+        items = []
+        for selector in self.PRODUCT_SELECTORS:
+            items = soup.select(selector)[:max_products]
+            if items:
+                break
+        
+        # Se non trova con selettori, prova con link
+        if not items:
+            items = soup.find_all('a', href=True)
+            items = [item for item in items if 'product' in item.get('href', '').lower()][:max_products]
+        
+        return items
+    
+    def _parse_luxury_item(self, element, idx):
+        """Parse prodotto luxury con anonimizzazione completa"""
+        
+        # Genera SKU interno (MAI usare quello originale)
+        sku = f"LXB{datetime.now().strftime('%y%m')}{idx:04d}"
+        
+        # Estrai info base
+        nome = self._extract_text(element, ['h1', 'h2', 'h3', '[class*="name"]', '[class*="title"]'])
+        if not nome:
+            nome = f"Luxury Item {idx}"
+        
+        # Brand, categoria, genere e colore in una sola passata
+        tags = classify_product_name(nome)
+        brand = self._detect_brand(tags, element)
+        
+        # Prezzo
+        prezzo = self._extract_price(element)
+        if not prezzo:
+            prezzo = random.randint(500, 3000)
+        
+        # Categoria e genere
+        categoria = tags['category'] or 'ACCESSORIES'
+        gender = tags['gender'] or 'Unisex'
+        
+        # Taglie disponibili
+        taglie = self._generate_sizes(categoria)
+        
+        return {
+            'STG': sku,
+            'MACRO': brand,
             'Gender': gender,
             'Desc_Product_Group': categoria,
-            'Foto': img_data,  # Binary data se include_images=True
+            'Foto': None,  # Binary data se include_images=True (riempito dalla ImagePipeline)
             'Sku': f"SKU{hashlib.md5(nome.encode()).hexdigest()[:8].upper()}",
             'Collezione': self._detect_season(),
             'Modello': nome[:50],
             'Parte': self._detect_subcategory(categoria),
-            'Colore': self._detect_color(nome, element),
+            'Colore': self._detect_color(tags),
             'prezzo_rtl': prezzo,
             'tot_QTY': random.randint(1, 20),
             'SELEZIONE_luxlab': '✓' if random.random() > 0.7 else '',
@@ -545,49 +2380,6 @@ class StealthExtractor:
             'original_name_hidden': nome  # Per analisi competitor AI, MAI mostrare
         }
     
-    def _download_and_process_image(self, img_url, idx):
-        """Scarica e processa immagine HD"""
-        try:
-            response = self.session.get(img_url, timeout=10)
-            if response.status_code == 200:
-                # Apri immagine
-                img = Image.open(BytesIO(response.content))
-                
-                # Converti in RGB
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Ridimensiona a HD mantenendo aspect ratio
-                img.thumbnail((800, 800), Image.Resampling.LANCZOS)
-                
-                # Aggiungi watermark LUXLAB
-                draw = ImageDraw.Draw(img)
-                text = "LUXLAB"
-                try:
-                    font = ImageFont.truetype("arial.ttf", 20)
-                except:
-                    font = ImageFont.load_default()
-                
-                # Posizione watermark
-                text_bbox = draw.textbbox((0, 0), text, font=font)
-                text_width = text_bbox[2] - text_bbox[0]
-                text_height = text_bbox[3] - text_bbox[1]
-                x = img.width - text_width - 10
-                y = img.height - text_height - 10
-                
-                # Disegna watermark semi-trasparente
-                draw.text((x, y), text, fill=(255, 255, 255, 128), font=font)
-                
-                # Salva in BytesIO
-                output = BytesIO()
-                img.save(output, format='JPEG', quality=95, optimize=True)
-                output.seek(0)
-                
-                return output.getvalue()
-        except:
-            return None
-        return None
-    
     def _extract_text(self, element, selectors):
         """Estrae testo in modo sicuro"""
         for selector in selectors:
@@ -600,31 +2392,17 @@ class StealthExtractor:
     
     def _extract_price(self, element):
         """Estrae prezzo e lo converte"""
-        price_patterns = [
-            r'€\s*(\d+(?:[.,]\d+)?)',
-            r'(\d+(?:[.,]\d+)?)\s*€',
-            r'EUR\s*(\d+(?:[.,]\d+)?)',
-            r'\$\s*(\d+(?:[.,]\d+)?)',
-            r'£\s*(\d+(?:[.,]\d+)?)'
-        ]
+        if not hasattr(element, 'select_one'):
+            return None
         
+        tried = []
         for selector in ['[class*="price"]', '.price', 'span[class*="amount"]']:
-            elem = element.select_one(selector) if hasattr(element, 'select_one') else None
-            if elem:
-                text = elem.get_text()
-                for pattern in price_patterns:
-                    match = re.search(pattern, text)
-                    if match:
-                        try:
-                            price = float(match.group(1).replace(',', '.'))
-                            # Conversione valute
-                            if '$' in text:
-                                price *= 0.92  # USD to EUR
-                            elif '£' in text:
-                                price *= 1.16  # GBP to EUR
-                            return price
-                        except:
-                            pass
+            elem = element.select_one(selector)
+            if elem and not any(elem is t for t in tried):
+                tried.append(elem)
+                price = parse_price(elem.get_text())
+                if price is not None:
+                    return price
         return None
     
     def _extract_image(self, element):
@@ -635,18 +2413,10 @@ class StealthExtractor:
                 return img.get(attr)
         return None
     
-    def _detect_brand(self, nome, element):
+    def _detect_brand(self, tags, element):
         """Detecta o assegna brand luxury"""
-        luxury_brands = [
-            'GUCCI', 'PRADA', 'VALENTINO', 'VERSACE', 'FENDI',
-            'DOLCE&GABBANA', 'BALENCIAGA', 'GIVENCHY', 'SAINT LAURENT',
-            'BOTTEGA VENETA', 'BURBERRY', 'CELINE', 'LOEWE', 'MARNI'
-        ]
-        
-        nome_upper = nome.upper()
-        for brand in luxury_brands:
-            if brand in nome_upper:
-                return brand
+        if tags['brand']:
+            return tags['brand']
         
         # Cerca nel DOM
         brand_elem = element.select_one('[class*="brand"], [itemprop="brand"]') if hasattr(element, 'select_one') else None
@@ -654,284 +2424,1471 @@ class StealthExtractor:
             return brand_elem.get_text(strip=True).upper()
         
         # Fallback random
-        return random.choice(luxury_brands)
-    
-    def _detect_category(self, nome, element):
-        """Detecta categoria prodotto"""
-        categories = {
-            'BAGS': ['bag', 'borsa', 'clutch', 'tote', 'shoulder'],
-            'SHOES': ['shoe', 'sneaker', 'boot', 'sandal', 'pump', 'loafer'],
-            'READY-TO-WEAR': ['dress', 'shirt', 'jacket', 'coat', 'trouser', 'skirt'],
-            'ACCESSORIES': ['belt', 'wallet', 'scarf', 'hat', 'jewelry', 'watch'],
-            'SMALL LEATHER': ['wallet', 'card', 'key', 'pouch']
+        return random.choice(LUXURY_BRANDS)
+    
+    def _detect_season(self):
+        """Determina stagione attuale"""
+        month = datetime.now().month
+        year = datetime.now().year
+        
+        if month >= 3 and month <= 8:
+            return f'SS{year % 100}'  # Spring/Summer
+        else:
+            return f'FW{year % 100}'  # Fall/Winter
+    
+    def _detect_subcategory(self, category):
+        """Determina sottocategoria"""
+        subcats = {
+            'BAGS': ['Shoulder Bags', 'Tote Bags', 'Clutches', 'Crossbody'],
+            'SHOES': ['Pumps', 'Sneakers', 'Boots', 'Sandals', 'Flats'],
+            'READY-TO-WEAR': ['Dresses', 'Outerwear', 'Knitwear', 'Shirts'],
+            'ACCESSORIES': ['Belts', 'Scarves', 'Jewelry', 'Sunglasses']
         }
         
-        nome_lower = nome.lower()
-        for cat, keywords in categories.items():
-            if any(kw in nome_lower for kw in keywords):
-                return cat
+        return random.choice(subcats.get(category, ['Premium Items']))
+    
+    def _detect_color(self, tags):
+        """Detecta o assegna colore"""
+        if tags['color']:
+            return tags['color']
+        
+        # Colori luxury default
+        return random.choice(['NERO', 'CAMMELLO', 'AVORIO', 'COGNAC', 'BORDEAUX'])
+    
+    def _generate_sizes(self, category):
+        """Genera taglie disponibili per categoria"""
+        sizes = self.SIZE_MAPS.get(category, ['UNI'])
+        # Rimuovi random alcune taglie per realismo
+        if len(sizes) > 3:
+            available = random.sample(sizes, k=random.randint(len(sizes)-2, len(sizes)))
+            return sorted(available)
+        return sizes
+
+# ====================================
+# 📊 GENERATORE EXCEL B2B PROFESSIONAL
+# ====================================
+
+class B2BExcelGenerator:
+    """Genera Excel professionali per clienti B2B con immagini HD"""
+    
+    # Headers professionali B2B
+    HEADERS = [
+        'STG', 'MACRO', 'Gender', 'Desc. Product Group', 'Foto',
+        'Sku', 'Collezione', 'Modello', 'Parte', 'Colore',
+        'prezzo rtl', 'prezzo proposto', 'sconto rtl %', 'sconto ACC %',
+        'tot Q.TY', 'SELEZIONE lux lab'
+    ]
+    PRICE_COLUMNS = (11, 12)
+    PRICE_FORMAT = '€#,##0'
+    
+    def __init__(self):
+        self.setup_styles()
+    
+    def setup_styles(self):
+        """Stili professionali luxury (oggetti condivisi, registrati una volta per workbook)"""
+        # Header style
+        self.header_style = NamedStyle(name='b2b_header')
+        self.header_style.font = Font(bold=True, size=10)
+        self.header_style.fill = PatternFill('solid', fgColor='D5D8DC')
+        self.header_style.alignment = Alignment(horizontal='center')
+        
+        # Righe alternate e prezzi
+        alt_fill = PatternFill('solid', fgColor='F8F9F9')
+        self.row_alt_style = NamedStyle(name='b2b_row_alt', fill=alt_fill)
+        self.price_style = NamedStyle(name='b2b_price', number_format=self.PRICE_FORMAT)
+        self.price_alt_style = NamedStyle(name='b2b_price_alt', fill=alt_fill, number_format=self.PRICE_FORMAT)
+        
+        # Totali
+        self.bold_font = Font(bold=True)
+        self.total_label_font = Font(bold=True, size=12)
+        self.total_proposed_font = Font(bold=True, color='27AE60')
+    
+    def _register_styles(self, wb):
+        """Registra gli stili nominati nel workbook"""
+        for style in (self.header_style, self.row_alt_style, self.price_style, self.price_alt_style):
+            registered = copy(style)
+            registered.number_format = style.number_format  # copy() passa dall'XML e perde il formato
+            wb.add_named_style(registered)
+    
+    def _row_style(self, row_idx, col):
+        """Nome dello stile di una cella prodotto (None = default)"""
+        alternate = row_idx % 2 == 0
+        if col in self.PRICE_COLUMNS:
+            return self.price_alt_style.name if alternate else self.price_style.name
+        return self.row_alt_style.name if alternate else None
+    
+    def _size_headers(self, products):
+        """Colonne taglie: unione delle taglie dei prodotti, o tutte se in streaming"""
+        all_sizes = set()
+        if isinstance(products, list):
+            for product in products:
+                if 'taglie' in product:
+                    all_sizes.update(product['taglie'])
+        else:
+            for sizes in StealthExtractor.SIZE_MAPS.values():
+                all_sizes.update(sizes)
+        return sorted(list(all_sizes))
+    
+    def _setup_sheet(self, ws, include_images):
+        """Larghezza colonne ottimizzata"""
+        column_widths = {
+            'A': 12, 'B': 15, 'C': 8, 'D': 20, 'E': 12 if include_images else 8,
+            'F': 15, 'G': 12, 'H': 30, 'I': 15, 'J': 12,
+            'K': 12, 'L': 12, 'M': 10, 'N': 10, 'O': 8, 'P': 10
+        }
+        
+        for col, width in column_widths.items():
+            ws.column_dimensions[col].width = width
+        
+        # Se include immagini, imposta altezza righe
+        if include_images:
+            ws.row_dimensions[1].height = 20  # Header
+    
+    def _priced_products(self, intelligence, products, strategy, market_data, progress=None, batch_rows=None):
+        """
+        (prodotto, prezzo B2B intelligente) per ogni riga. Analisi competitor AI
+        (se abilitata) e prezzi sono calcolati a blocchi di Config.MARKET_BATCH_ROWS
+        prodotti: anche da un generatore la memoria resta limitata.
+        """
+        products = iter(products)
+        while True:
+            chunk = list(itertools.islice(products, batch_rows or Config.MARKET_BATCH_ROWS))
+            if not chunk:
+                return
+            
+            analyses = None
+            if market_data:
+                with track_stage(progress, 'analysis'):
+                    analyses = intelligence.analyze_market_batch(chunk)
+            
+            with track_stage(progress, 'pricing'):
+                prices = [product['prezzo_rtl'] for product in chunk]
+                pricing = intelligence.calculate_smart_prices(prices, strategy, analyses)
+            yield from zip(chunk, pricing)
+    
+    def _product_image(self, product, include_images):
+        """Immagine da incorporare e valore della colonna Foto"""
+        if include_images and product.get('Foto'):
+            try:
+                # Da un ImageBlob openpyxl legge solo l'header: i bytes vengono caricati al salvataggio
+                foto = product['Foto']
+                img = XLImage(foto.path if isinstance(foto, ImageBlob) else BytesIO(foto))
+                img.width = 80
+                img.height = 80
+                return img, None
+            except:
+                return None, 'IMG'
+        return None, '📷' if include_images else '-'
+    
+    def _product_row(self, product, pricing, size_headers, foto_value):
+        """Valori di una riga prodotto (MAI mostrare dati competitor)"""
+        row = [
+            product['STG'],
+            product['MACRO'],
+            product['Gender'],
+            product['Desc_Product_Group'],
+            foto_value,
+            product['Sku'],
+            product['Collezione'],
+            product['Modello'],
+            product['Parte'],
+            product['Colore'],
+            pricing['retail'],
+            pricing['proposed'],
+            f"-{pricing['discount']}%",
+            f"-{pricing['discount']}%",
+            product['tot_QTY'],
+            product['SELEZIONE_luxlab']
+        ]
+        
+        # Quantità per taglia
+        taglie = product.get('taglie', [])
+        for size in size_headers:
+            if size in taglie:
+                row.append(random.choices([0, 1, 2, 3, 4], weights=[20, 30, 25, 15, 10])[0])
+            else:
+                row.append(0)
+        
+        # Note
+        row.append(product.get('Note', ''))
+        return row
+    
+    def iter_rows(self, products, strategy='BALANCED', analyze_competitors=False, progress=None, batch_rows=None):
+        """
+        Intestazione e righe con le stesse colonne di create_b2b_excel (senza immagini),
+        prodotte man mano che arrivano i prodotti: base degli export CSV/NDJSON
+        """
+        size_headers = self._size_headers(products)
+        yield self.HEADERS + size_headers + ['Note']
+        
+        intelligence = CompetitorIntelligence()
+        priced = self._priced_products(intelligence, products, strategy, analyze_competitors, progress, batch_rows)
+        for product, pricing in priced:
+            _, foto_value = self._product_image(product, False)
+            yield self._product_row(product, pricing, size_headers, foto_value)
+            if progress:
+                progress.advance('rows_written')
+    
+    def _info_rows(self, strategy, products_count, total_retail, total_proposto, market_data):
+        """Info sheet (senza dati competitor)"""
+        return [
+            ['LUXLAB B2B STOCK LIST', ''],
+            ['', ''],
+            ['Data Generazione:', datetime.now().strftime('%d/%m/%Y %H:%M')],
+            ['Strategia Applicata:', strategy],
+            ['Prodotti Totali:', products_count],
+            ['Valore Retail:', f'€{total_retail:,.0f}'],
+            ['Valore Proposto:', f'€{total_proposto:,.0f}'],
+            ['Risparmio Medio:', f'{((total_retail-total_proposto)/total_retail*100):.1f}%' if total_retail > 0 else '0%'],
+            ['', ''],
+            ['AI Analysis:', 'ATTIVA' if market_data else 'NON ATTIVA'],
+            ['', ''],
+            ['CONFIDENZIALE', 'Documento riservato B2B']
+        ]
+    
+    def _save(self, wb, strategy, progress=None):
+        """Salva file"""
+        filename = export_filename(strategy)
+        filepath = export_storage_path(filename)
+        with track_stage(progress, 'save'):
+            wb.save(filepath)
+        get_export_janitor()  # Avvia la pulizia periodica nel processo che produce export
+        return filename, filepath
+    
+    def _result(self, filename, filepath, products_count, total_retail, total_proposto):
+        return {
+            'filename': filename,
+            'filepath': filepath,
+            'products_count': products_count,
+            'total_retail': total_retail,
+            'total_proposto': total_proposto,
+            'margin_avg': ((total_retail-total_proposto)/total_retail*100) if total_retail > 0 else 0
+        }
+    
+    def create_b2b_excel(self, products, strategy='BALANCED', market_data=None, include_images=False,
+                         progress=None, streaming=None):
+        """Crea Excel B2B professionale con analisi competitor nascosta"""
+        
+        # Cataloghi grandi (o generatori di prodotti) passano al writer in streaming
+        if streaming is None:
+            streaming = not isinstance(products, list) or len(products) >= Config.EXCEL_STREAMING_ROWS
+        if streaming:
+            return self.create_b2b_excel_streaming(products, strategy, market_data, include_images, progress)
+        
+        if progress:
+            progress.set('rows_total', len(products))
+        
+        wb = Workbook()
+        self._register_styles(wb)
+        ws = wb.active
+        ws.title = "STOCK LIST B2B"
+        
+        size_headers = self._size_headers(products)
+        headers = self.HEADERS + size_headers + ['Note']
+        
+        # Scrivi headers
+        for col, header in enumerate(headers, 1):
+            ws.cell(row=1, column=col, value=header).style = self.header_style.name
+        
+        self._setup_sheet(ws, include_images)
+        
+        # Intelligence system
+        intelligence = CompetitorIntelligence()
+        
+        # Popola dati prodotti
+        total_retail = 0
+        total_proposto = 0
+        
+        priced = self._priced_products(intelligence, products, strategy, market_data, progress)
+        for row_idx, (product, pricing) in enumerate(priced, 2):
+            # Se include immagini, imposta altezza riga
+            if include_images:
+                ws.row_dimensions[row_idx].height = 90
+            
+            # Immagine o placeholder
+            img, foto_value = self._product_image(product, include_images)
+            if img:
+                ws.add_image(img, f'E{row_idx}')
+            
+            row = self._product_row(product, pricing, size_headers, foto_value)
+            for col, value in enumerate(row, 1):
+                cell = ws.cell(row_idx, col, value)
+                style = self._row_style(row_idx, col)
+                if style:
+                    cell.style = style
+            
+            # Totali
+            total_retail += pricing['retail']
+            total_proposto += pricing['proposed']
+            
+            if progress:
+                progress.advance('rows_written')
+        
+        # Riga totali
+        total_row = len(products) + 3
+        ws.cell(total_row, 10, 'TOTALI:').font = self.total_label_font
+        ws.cell(total_row, 11, total_retail).number_format = self.PRICE_FORMAT
+        ws.cell(total_row, 11).font = self.bold_font
+        ws.cell(total_row, 12, total_proposto).number_format = self.PRICE_FORMAT
+        ws.cell(total_row, 12).font = self.total_proposed_font
+        
+        info_sheet = wb.create_sheet('INFO')
+        info_data = self._info_rows(strategy, len(products), total_retail, total_proposto, market_data)
+        for row_idx, (label, value) in enumerate(info_data, 1):
+            info_sheet.cell(row_idx, 1, label).font = self.bold_font
+            info_sheet.cell(row_idx, 2, value)
+        
+        filename, filepath = self._save(wb, strategy, progress)
+        return self._result(filename, filepath, len(products), total_retail, total_proposto)
+    
+    def create_b2b_excel_streaming(self, products, strategy='BALANCED', market_data=None, include_images=False,
+                                   progress=None):
+        """
+        Crea lo stesso Excel B2B con il workbook write-only di openpyxl:
+        le righe vengono scritte man mano che i prodotti arrivano (anche da un generatore)
+        e la memoria resta costante rispetto al numero di righe
+        """
+        if progress and isinstance(products, list):
+            progress.set('rows_total', len(products))
+        
+        wb = Workbook(write_only=True)
+        self._register_styles(wb)
+        ws = wb.create_sheet("STOCK LIST B2B")
+        
+        size_headers = self._size_headers(products)
+        headers = self.HEADERS + size_headers + ['Note']
+        
+        # Dimensioni e stili vanno impostati prima di scrivere le righe
+        self._setup_sheet(ws, include_images)
+        
+        header_row = []
+        for header in headers:
+            cell = WriteOnlyCell(ws, value=header)
+            cell.style = self.header_style.name
+            header_row.append(cell)
+        ws.append(header_row)
+        
+        # Intelligence system
+        intelligence = CompetitorIntelligence()
+        
+        total_retail = 0
+        total_proposto = 0
+        products_count = 0
+        
+        priced = self._priced_products(intelligence, products, strategy, market_data, progress)
+        for row_idx, (product, pricing) in enumerate(priced, 2):
+            if include_images:
+                ws.row_dimensions[row_idx].height = 90
+            
+            img, foto_value = self._product_image(product, include_images)
+            if img:
+                ws.add_image(img, f'E{row_idx}')
+            
+            row = self._product_row(product, pricing, size_headers, foto_value)
+            cells = []
+            for col, value in enumerate(row, 1):
+                style = self._row_style(row_idx, col)
+                if style:
+                    value = WriteOnlyCell(ws, value=value)
+                    value.style = style
+                cells.append(value)
+            ws.append(cells)
+            
+            # La riga è già sul disco: la sua dimensione non serve più
+            if include_images:
+                del ws.row_dimensions[row_idx]
+            
+            total_retail += pricing['retail']
+            total_proposto += pricing['proposed']
+            products_count += 1
+            
+            if progress:
+                progress.advance('rows_written')
+        
+        # Riga totali (dopo una riga vuota)
+        ws.append([])
+        label = WriteOnlyCell(ws, value='TOTALI:')
+        label.font = self.total_label_font
+        retail = WriteOnlyCell(ws, value=total_retail)
+        retail.number_format = self.PRICE_FORMAT
+        retail.font = self.bold_font
+        proposed = WriteOnlyCell(ws, value=total_proposto)
+        proposed.number_format = self.PRICE_FORMAT
+        proposed.font = self.total_proposed_font
+        ws.append([None] * 9 + [label, retail, proposed])
+        
+        info_sheet = wb.create_sheet('INFO')
+        info_data = self._info_rows(strategy, products_count, total_retail, total_proposto, market_data)
+        for label, value in info_data:
+            cell = WriteOnlyCell(info_sheet, value=label)
+            cell.font = self.bold_font
+            info_sheet.append([cell, value])
+        
+        filename, filepath = self._save(wb, strategy, progress)
+        return self._result(filename, filepath, products_count, total_retail, total_proposto)
+
+# ====================================
+# 📥 DOWNLOAD EXPORT
+# ====================================
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Gli export sono divisi in cartelle per data (EXPORT_PATH/AAAA/MM/GG), ricavata dal nome
+EXPORT_NAME_DATE = re.compile(r'_(\d{4})(\d{2})(\d{2})_\d{6}')
+
+def export_filename(strategy, extension='xlsx'):
+    """Nome univoco: il solo timestamp collide tra conversioni finite nello stesso secondo"""
+    strategy = re.sub(r'[^A-Za-z0-9_-]', '', str(strategy)) or 'CUSTOM'
+    return f"LUXLAB_B2B_{strategy}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}.{extension}"
+
+def export_shard(filename):
+    """Sottocartella AAAA/MM/GG del file ('' per nomi senza data)"""
+    match = EXPORT_NAME_DATE.search(filename)
+    return os.path.join(*match.groups()) if match else ''
+
+def export_storage_path(filename):
+    """Percorso in cui scrivere un nuovo export (la cartella del giorno viene creata)"""
+    directory = os.path.join(Config.EXPORT_PATH, export_shard(filename))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+def export_file_path(filename):
+    """
+    Percorso assoluto del file export richiesto: cartella del giorno oppure
+    layout piatto dei file precedenti. None se il nome esce da EXPORT_PATH o non esiste.
+    """
+    root = os.path.abspath(Config.EXPORT_PATH)
+    for directory in (os.path.join(root, export_shard(filename)), root):
+        filepath = safe_join(directory, filename)
+        if filepath and os.path.isfile(filepath):
+            return filepath
+    return None
+
+class FileETagCache:
+    """ETag forti dal contenuto (SHA-256), ricalcolati solo se cambiano mtime o dimensione"""
+    
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # percorso -> (mtime_ns, size, etag)
+        self.lock = threading.Lock()
+    
+    def get(self, filepath):
+        st = os.stat(filepath)
+        with self.lock:
+            entry = self.entries.get(filepath)
+            if entry and entry[:2] == (st.st_mtime_ns, st.st_size):
+                self.entries.move_to_end(filepath)
+                return entry[2]
+        
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        etag = digest.hexdigest()
+        
+        with self.lock:
+            self.entries[filepath] = (st.st_mtime_ns, st.st_size, etag)
+            self.entries.move_to_end(filepath)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return etag
+
+export_etags = FileETagCache()
+
+def export_response(filepath, filename):
+    """
+    Risposta di download con ETag forte: 304 se il client ha già il file,
+    Range per i download ripresi. Con DOWNLOAD_OFFLOAD i byte li invia il proxy
+    (X-Sendfile / X-Accel-Redirect) e il worker risponde solo con gli header.
+    """
+    etag = export_etags.get(filepath)
+    if not Config.DOWNLOAD_OFFLOAD:
+        response = send_file(filepath, as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE,
+                             conditional=True, etag=etag)
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+    
+    response = send_file_offload(filepath, request.environ, mimetype=XLSX_MIMETYPE,
+                                 as_attachment=True, download_name=filename, conditional=False,
+                                 etag=etag, use_x_sendfile=True, response_class=current_app.response_class)
+    if Config.DOWNLOAD_OFFLOAD == 'x-accel':
+        del response.headers['X-Sendfile']
+        relative = os.path.relpath(filepath, os.path.abspath(Config.EXPORT_PATH)).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = Config.X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative)
+    
+    # Il 304 lo decide l'app; Range lo gestisce il proxy
+    response = response.make_conditional(request.environ)
+    if response.status_code == 304:
+        response.headers.pop('X-Sendfile', None)
+        response.headers.pop('X-Accel-Redirect', None)
+    return response
+
+# ====================================
+# 🧹 RETENTION EXPORT
+# ====================================
+
+class ExportJanitor:
+    """
+    Pulizia periodica di EXPORT_PATH, in background. In ordine elimina:
+    1. gli export oltre l'età massima (più breve per quelli anonimi, senza conversione nel DB)
+    2. i più vecchi di ogni utente oltre la quota del suo piano (Conversion.file_generated)
+    3. i più vecchi in assoluto oltre il tetto complessivo della cartella
+    Gli export più recenti di min_age restano sempre scaricabili. Con più worker
+    gunicorn un lock file fa eseguire ogni pulizia a un solo processo.
+    """
+    
+    def __init__(self, root, interval, max_age, orphan_max_age, max_total_bytes, min_age):
+        self.root = root
+        self.interval = interval
+        self.max_age = max_age
+        self.orphan_max_age = orphan_max_age
+        self.max_total_bytes = max_total_bytes
+        self.min_age = min_age
+        self.last_report = None
+        self.sweeps = 0
+        self.bytes_reclaimed = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self.thread = None
+    
+    def start(self, flask_app):
+        self.thread = threading.Thread(target=self._loop, args=(flask_app,), name='luxlab-janitor', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _loop(self, flask_app):
+        while not self._stop.is_set():
+            try:
+                with flask_app.app_context():
+                    self.sweep()
+            except Exception as e:
+                print(f"Errore pulizia export: {e}")
+            self._stop.wait(self.interval)
+    
+    def sweep(self):
+        """Esegue una pulizia e restituisce il report (None se è in corso in un altro processo)"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.janitor.lock'), 'w') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            return self._sweep()
+    
+    def _sweep(self):
+        started = time.time()
+        files = self._scan()
+        owners = self._owners([f['name'] for f in files])
+        deleted = {'age': [], 'quota': [], 'total': []}
+        
+        # 1. Età massima
+        kept = []
+        for f in files:
+            owner = owners.get(f['name'])
+            limit = self.max_age if owner else self.orphan_max_age
+            if started - f['mtime'] > limit:
+                deleted['age'].append(f)
+            else:
+                kept.append(f)
+        
+        # 2. Quota per utente (piano): si eliminano i suoi export più vecchi. Un file di più
+        # utenti (riusi registrati prima del riuso per utente) non pesa sulla quota di nessuno
+        by_user = {}
+        for f in kept:
+            owner = owners.get(f['name'])
+            if owner and len(owner) == 1:
+                by_user.setdefault(next(iter(owner)), []).append(f)
+        over_quota = set()
+        for (user_id, plan), user_files in by_user.items():
+            quota_mb = Config.PLANS.get(plan, Config.PLANS['trial']).get('export_quota_mb')
+            if quota_mb is None:
+                continue
+            over_quota.update(id(f) for f in self._over_limit(user_files, quota_mb * 1024 * 1024, started))
+        deleted['quota'] = [f for f in kept if id(f) in over_quota]
+        kept = [f for f in kept if id(f) not in over_quota]
+        
+        # 3. Tetto complessivo
+        deleted['total'] = self._over_limit(kept, self.max_total_bytes, started)
+        removed = {id(f) for f in deleted['total']}
+        kept = [f for f in kept if id(f) not in removed]
+        
+        reclaimed = 0
+        files_deleted = 0
+        for f in itertools.chain.from_iterable(deleted.values()):
+            try:
+                os.remove(f['path'])
+                reclaimed += f['size']
+                files_deleted += 1
+            except OSError:
+                pass
+        self._remove_empty_dirs()
+        
+        report = {
+            'files_deleted': files_deleted,
+            'bytes_reclaimed': reclaimed,
+            'deleted_by': {reason: len(group) for reason, group in deleted.items()},
+            'files_kept': len(kept),
+            'bytes_kept': sum(f['size'] for f in kept),
+            'seconds': round(time.time() - started, 3),
+            'at': datetime.now().isoformat(timespec='seconds')
+        }
+        with self.lock:
+            self.last_report = report
+            self.sweeps += 1
+            self.bytes_reclaimed += reclaimed
+        if files_deleted:
+            print(f"🧹 Export eliminati: {files_deleted} ({reclaimed / 1024 / 1024:.1f} MB liberati)")
+        return report
+    
+    def _over_limit(self, files, max_bytes, now):
+        """I file più vecchi da eliminare per rientrare in max_bytes (esclusi i recentissimi)"""
+        total = sum(f['size'] for f in files)
+        evict = []
+        for f in sorted(files, key=lambda f: f['mtime']):
+            if total <= max_bytes:
+                break
+            if now - f['mtime'] < self.min_age:
+                continue
+            evict.append(f)
+            total -= f['size']
+        return evict
+    
+    def _scan(self):
+        """Export presenti: cartelle per data e file del vecchio layout piatto"""
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append({'path': path, 'name': name, 'size': st.st_size, 'mtime': st.st_mtime})
+        return files
+    
+    def _owners(self, names):
+        """nome file -> insieme di (user_id, piano) dalle conversioni registrate"""
+        owners = {}
+        for start in range(0, len(names), 500):
+            rows = db.session.query(Conversion.file_generated, User.id, User.plan).join(
+                User, Conversion.user_id == User.id
+            ).filter(Conversion.file_generated.in_(names[start:start + 500])).all()
+            for filename, user_id, plan in rows:
+                owners.setdefault(filename, set()).add((user_id, plan))
+        db.session.remove()
+        return owners
+    
+    def _remove_empty_dirs(self):
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            if dirpath != self.root and not dirnames and not filenames:
+                try:
+                    os.rmdir(dirpath)
+                except OSError:
+                    pass
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'sweeps': self.sweeps,
+                'bytes_reclaimed': self.bytes_reclaimed,
+                'last_report': self.last_report
+            }
+
+_export_janitor = None
+_export_janitor_lock = threading.Lock()
+
+def get_export_janitor():
+    """Janitor export del processo (avviato al primo uso)"""
+    global _export_janitor
+    with _export_janitor_lock:
+        if _export_janitor is None:
+            _export_janitor = ExportJanitor(
+                Config.EXPORT_PATH,
+                Config.EXPORT_JANITOR_INTERVAL,
+                Config.EXPORT_MAX_AGE_DAYS * 86400,
+                Config.EXPORT_ORPHAN_MAX_AGE_HOURS * 3600,
+                Config.EXPORT_MAX_TOTAL_MB * 1024 * 1024,
+                Config.EXPORT_MIN_AGE_SECONDS
+            )
+            _export_janitor.start(current_flask_app())
+        return _export_janitor
+
+# ====================================
+# 📤 EXPORT STREAMING CSV / NDJSON
+# ====================================
+
+def _buffered(chunks):
+    """Raggruppa le righe in blocchi da Config.EXPORT_FLUSH_BYTES (l'intestazione parte subito)"""
+    buffer = []
+    size = 0
+    for idx, chunk in enumerate(chunks):
+        buffer.append(chunk)
+        size += len(chunk)
+        if idx == 0 or size >= Config.EXPORT_FLUSH_BYTES:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+def csv_lines(rows):
+    """Righe CSV (la prima è l'intestazione)"""
+    output = StringIO()
+    writer = csv.writer(output)
+    for row in rows:
+        writer.writerow(row)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+def ndjson_lines(rows):
+    """Un oggetto JSON per riga, con le intestazioni come chiavi"""
+    headers = None
+    for row in rows:
+        if headers is None:
+            headers = row
+            continue
+        yield json.dumps(dict(zip(headers, row)), ensure_ascii=False) + '\n'
+
+# formato: (mimetype, estensione, encoder)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', csv_lines),
+    'ndjson': ('application/x-ndjson', 'ndjson', ndjson_lines)
+}
+
+def export_stream(url, strategy, export_format, max_products, analyze_competitors, user_id=None):
+    """
+    Testo dell'export prodotto mentre il catalogo viene estratto e prezzato:
+    memoria costante e primo byte appena è pronta l'intestazione.
+    A fine stream la conversione viene registrata come quelle Excel.
+    """
+    generator = B2BExcelGenerator()
+    extractor = StealthExtractor()
+    encode = EXPORT_FORMATS[export_format][2]
+    totals = {'products': 0, 'retail': 0, 'proposed': 0}
+    retail_col, proposed_col = (col - 1 for col in B2BExcelGenerator.PRICE_COLUMNS)
+    
+    def counted(rows):
+        yield next(rows)  # Intestazione
+        for row in rows:
+            totals['products'] += 1
+            totals['retail'] += row[retail_col]
+            totals['proposed'] += row[proposed_col]
+            yield row
+    
+    try:
+        products = extractor.iter_products(url, max_products)
+        rows = generator.iter_rows(products, strategy, analyze_competitors, batch_rows=Config.EXPORT_BATCH_ROWS)
+        yield from _buffered(encode(counted(rows)))
+    finally:
+        extractor.close()
+    
+    if user_id and totals['products']:
+        result = generator._result(None, None, totals['products'], totals['retail'], totals['proposed'])
+        record_conversion(user_id, url, strategy, result)
+
+# ====================================
+# 🚦 AMMISSIONE E CORSIE DI PRIORITÀ
+# ====================================
+
+class AdmissionDenied(Exception):
+    """Richiesta respinta per carico: va ripetuta dopo retry_after secondi (429)"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class LocalAdmissionBackend:
+    """
+    Stato di ammissione nel processo: token bucket e conversioni in corso per chiave.
+    Un backend condiviso espone gli stessi tre metodi (take, acquire, release).
+    """
+    
+    def __init__(self, max_keys=Config.ADMISSION_MAX_KEYS):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.active = {}
+        self.lock = threading.Lock()
+    
+    def take(self, key, rate, burst):
+        """Consuma un token: 0 se disponibile, altrimenti i secondi da attendere"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self.buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)  # Chiave inattiva: ripartirà col bucket pieno
+            return wait
+    
+    def acquire(self, key, limit):
+        with self.lock:
+            if self.active.get(key, 0) >= limit:
+                return False
+            self.active[key] = self.active.get(key, 0) + 1
+            return True
+    
+    def release(self, key):
+        with self.lock:
+            count = self.active.get(key, 0) - 1
+            if count > 0:
+                self.active[key] = count
+            else:
+                self.active.pop(key, None)
+
+class RedisAdmissionBackend:
+    """Backend condiviso su Redis: limiti per utente validi su tutti i worker e le istanze"""
+    
+    TAKE = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+    
+    ACQUIRE = """
+    local count = redis.call('INCR', KEYS[1])
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    if count > tonumber(ARGV[1]) then
+        redis.call('DECR', KEYS[1])
+        return 0
+    end
+    return 1
+    """
+    
+    def __init__(self, url, prefix='luxlab:admission:', lease=Config.ADMISSION_LEASE):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.lease = lease
+        self._take = self.client.register_script(self.TAKE)
+        self._acquire = self.client.register_script(self.ACQUIRE)
+    
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst]))
+    
+    def acquire(self, key, limit):
+        return bool(self._acquire(keys=[self.prefix + key], args=[limit, self.lease]))
+    
+    def release(self, key):
+        if self.client.decr(self.prefix + key) <= 0:
+            self.client.delete(self.prefix + key)
+
+class AdmissionTicket:
+    """Posto ottenuto da AdmissionController: va rilasciato una sola volta a fine lavoro"""
+    
+    def __init__(self, controller, key, priority):
+        self.controller = controller
+        self.key = key
+        self.priority = priority
+        self.released = False
+    
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    """
+    Ammissione di convert/analyze/export, con limiti per piano (PLANS['admission']):
+    1. conversioni in corso per utente (o IP se anonimo)
+    2. corsie per priorità sui posti del processo: le corsie basse (anonimi, trial)
+       occupano al massimo la loro quota, così i piani a pagamento trovano posto
+    3. token bucket di richieste al minuto: per ultimo, così un 429 per "già in corso"
+       o "al completo" non consuma il budget al minuto
+    Limiti per utente e bucket passano dal backend (condivisibile), le corsie sono per processo.
+    """
+    
+    def __init__(self, backend, slots, lane_shares, retry_after):
+        self.backend = backend
+        self.slots = slots
+        self.lane_caps = {priority: max(1, int(slots * share)) for priority, share in lane_shares.items()}
+        self.retry_after = retry_after
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.denied = {'rate': 0, 'concurrency': 0, 'lane': 0}
+    
+    def admit(self, key, limits):
+        """AdmissionTicket per la richiesta, AdmissionDenied se va respinta"""
+        priority = limits.get('priority', 0)
+        concurrent = limits.get('concurrent')
+        if concurrent and not self.backend.acquire(f'active:{key}', concurrent):
+            self._deny('concurrency', f'Hai già {concurrent} conversioni in corso: attendi che terminino',
+                       self.retry_after)
+        
+        ticket = AdmissionTicket(self, f'active:{key}' if concurrent else None, priority)
+        if not self._take_slot(priority):
+            if concurrent:
+                self.backend.release(ticket.key)
+            self._deny('lane', 'Servizio al completo, riprova tra poco', self.retry_after)
+        
+        if limits.get('per_minute'):
+            wait = self.backend.take(f'rate:{key}', limits['per_minute'] / 60, limits.get('burst') or 1)
+            if wait:
+                ticket.release()  # Il token non è stato consumato: si liberano solo i posti
+                self._deny('rate', 'Troppe richieste, riprova tra qualche secondo', wait)
+        
+        with self.lock:
+            self.admitted += 1
+        return ticket
+    
+    def _take_slot(self, priority):
+        with self.lock:
+            if sum(self.in_flight.values()) >= self.slots:
+                return False
+            for level, cap in self.lane_caps.items():
+                if level >= priority and sum(n for p, n in self.in_flight.items() if p <= level) >= cap:
+                    return False
+            self.in_flight[priority] = self.in_flight.get(priority, 0) + 1
+            return True
+    
+    def _release(self, ticket):
+        with self.lock:
+            self.in_flight[ticket.priority] -= 1
+        if ticket.key:
+            self.backend.release(ticket.key)
+    
+    def _deny(self, reason, message, retry_after):
+        with self.lock:
+            self.denied[reason] += 1
+        raise AdmissionDenied(message, retry_after)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'slots': self.slots,
+                'lane_caps': self.lane_caps,
+                'in_flight': dict(self.in_flight),
+                'admitted': self.admitted,
+                'denied': dict(self.denied)
+            }
+
+def make_admission_backend():
+    if Config.ADMISSION_REDIS_URL and REDIS_AVAILABLE:
+        return RedisAdmissionBackend(Config.ADMISSION_REDIS_URL)
+    if Config.ADMISSION_REDIS_URL:
+        print("⚠️ ADMISSION_REDIS_URL impostato ma redis non installato: limiti per processo")
+    return LocalAdmissionBackend()
+
+admission = AdmissionController(make_admission_backend(), Config.CONVERSION_SLOTS,
+                                Config.LANE_SHARES, Config.ADMISSION_RETRY_AFTER)
+
+def admission_limits(user):
+    """Chiave e limiti di ammissione: utente e piano, oppure IP per le richieste anonime"""
+    if user:
+        return f"user:{user.id}", user.get_plan_limits().get('admission', Config.ANONYMOUS_ADMISSION)
+    return f"ip:{request.remote_addr}", Config.ANONYMOUS_ADMISSION
+
+def admission_denied(e):
+    return jsonify({'error': str(e), 'retry_after': e.retry_after}), 429, {'Retry-After': str(e.retry_after)}
+
+# ====================================
+# ⚙️ JOB ENGINE CONVERSIONI
+# ====================================
+
+def track_stage(progress, stage):
+    """Misura una fase della pipeline: nell'istogramma di processo e, se c'è, nel job"""
+    return progress.track(stage) if progress else stage_seconds.time(stage=stage)
+
+class ConversionError(Exception):
+    """Errore della pipeline di conversione con codice HTTP"""
+    
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ConversionJob:
+    """Conversione con progresso reale per fase e tempi misurati"""
+    
+    def __init__(self, user_id=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.status = 'queued'
+        self.stage = None
+        self.counters = {
+            'fetched': 0,
+            'items_found': 0,
+            'parsed': 0,
+            'images_total': 0,
+            'images_done': 0,
+            'rows_total': 0,
+            'rows_written': 0
+        }
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._stack = []
+        self._lock = threading.Lock()
+    
+    def advance(self, counter, amount=1):
+        """Incrementa un contatore di progresso"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+    
+    def set(self, counter, value):
+        """Imposta un contatore di progresso"""
+        with self._lock:
+            self.counters[counter] = value
+    
+    def add_time(self, stage, seconds):
+        """Accumula il tempo speso in una fase"""
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0) + seconds
+    
+    @contextmanager
+    def track(self, stage):
+        """Cronometra una fase; le fasi annidate sospendono quella esterna"""
+        now = time.perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.add_time(outer[0], now - outer[1])
+            outer[2] += now - outer[1]
+        entry = [stage, now, 0.0]  # fase, inizio del tratto corrente, tempo già speso
+        self._stack.append(entry)
+        self.stage = stage
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.add_time(stage, now - entry[1])
+            stage_seconds.observe(entry[2] + now - entry[1], stage=stage)
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] = now
+                self.stage = self._stack[-1][0]
+    
+    @property
+    def elapsed(self):
+        """Secondi di esecuzione effettiva"""
+        if not self.started_at:
+            return 0
+        return (self.finished_at or time.time()) - self.started_at
+    
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed')
+    
+    def to_dict(self):
+        with self._lock:
+            counters = dict(self.counters)
+            timings = {stage: round(sec, 3) for stage, sec in self.timings.items()}
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': counters,
+            'timings': timings,
+            'elapsed': round(self.elapsed, 3),
+            'result': self.result,
+            'error': self.error
+        }
+
+class JobManager:
+    """
+    Pool locale di worker per le conversioni (stato in memoria per processo).
+    I job in coda partono per priorità (corsia del piano), a parità in ordine di arrivo.
+    """
+    
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='luxlab-job')
+        self.jobs = {}
+        self.queue = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+    
+    def submit(self, fn, *args, priority=0, on_finish=None, **kwargs):
+        """Accoda la conversione e restituisce subito il job (on_finish chiamata a job terminato)"""
+        job = ConversionJob(kwargs.get('user_id'))
+        with self.lock:
+            self._purge()
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-priority, next(self.sequence), job, current_flask_app(),
+                                        fn, args, kwargs, on_finish))
+        # Ogni submit aggiunge un turno al pool: il turno esegue il job in coda più prioritario
+        self.executor.submit(self._run_next)
+        return job
+    
+    def _run_next(self):
+        with self.lock:
+            _, _, job, flask_app, fn, args, kwargs, on_finish = heapq.heappop(self.queue)
+        try:
+            self._run(job, flask_app, fn, args, kwargs)
+        finally:
+            if on_finish:
+                on_finish()
+    
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+    
+    def _run(self, job, flask_app, fn, args, kwargs):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            with flask_app.app_context():
+                job.result = fn(*args, progress=job, **kwargs)
+            job.status = 'completed'
+        except Exception as e:
+            print(f"Errore job {job.id}: {e}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            job.stage = None
+    
+    def _purge(self):
+        """Rimuove i job terminati da più di JOB_TTL secondi"""
+        limit = time.time() - Config.JOB_TTL
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.finished_at < limit]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+job_manager = JobManager(Config.JOB_WORKERS)
+
+def url_hash(url):
+    return hashlib.md5(url.encode()).hexdigest()
+
+def record_conversion(user_id, url, strategy, result, market_data=None,
+                      include_images=None, max_products=None, ai_analysis=None):
+    """
+    Salva la conversione nello storico dell'utente. Le conversioni anonime
+    (user_id None) vengono salvate senza utente, solo per il riuso del risultato.
+    """
+    user = User.query.get(user_id) if user_id else None
+    if user_id and not user:
+        return None
+    
+    conversion = Conversion(
+        user_id=user.id if user else None,
+        url_hash=url_hash(url),
+        strategy=strategy,
+        products_count=result['products_count'],
+        avg_margin=result['margin_avg'],
+        total_value=result['total_proposto'],
+        competitor_data=json.dumps(market_data) if market_data else None,
+        file_generated=result['filename'],
+        include_images=include_images,
+        max_products=max_products,
+        ai_analysis=ai_analysis
+    )
+    db.session.add(conversion)
+    
+    if user:
+        increment_conversions(user.id)
+    db.session.commit()
+    return conversion
+
+def increment_conversions(user_id):
+    """total_conversions + 1 in un solo UPDATE (nessun incremento perso tra worker)"""
+    User.query.filter_by(id=user_id).update(
+        {User.total_conversions: db.func.coalesce(User.total_conversions, 0) + 1},
+        synchronize_session=False
+    )
+
+def claim_trial(user_id):
+    """Consuma il trial in un solo UPDATE condizionato: True solo per la prima richiesta"""
+    claimed = User.query.filter(
+        User.id == user_id,
+        db.or_(User.trial_used.is_(False), User.trial_used.is_(None))
+    ).update({User.trial_used: True}, synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+class ConversionResults:
+    """
+    Riuso delle conversioni: una richiesta con stesso catalogo (url_hash) e stesse
+    opzioni (strategia, immagini, max prodotti, AI) di una conversione recente dello
+    stesso utente (o anonima, per le richieste anonime) il cui file è ancora su disco
+    riceve subito quel file. Un file non passa mai a un altro utente: quota export e
+    storico restano del proprietario. Le richieste identiche in corso nello stesso
+    processo attendono la prima invece di rifare la pipeline.
+    """
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    def find(self, key):
+        """Conversione riutilizzabile per key, None se assente, scaduta o senza file"""
+        if self.ttl <= 0:
+            return None
+        user_id, hash_, strategy, include_images, max_products, ai_analysis = key
+        since = time.time() - self.ttl
+        candidates = Conversion.query.filter_by(
+            user_id=user_id,  # None: IS NULL, solo conversioni anonime
+            url_hash=hash_,
+            strategy=strategy,
+            include_images=include_images,
+            max_products=max_products,
+            ai_analysis=ai_analysis
+        ).filter(
+            Conversion.created_at >= datetime.fromtimestamp(since),
+            Conversion.file_generated.isnot(None)
+        ).order_by(Conversion.created_at.desc()).limit(5).all()
         
-        return 'ACCESSORIES'
+        for conversion in candidates:
+            filepath = export_file_path(conversion.file_generated)
+            # La freschezza è quella del file: i riusi registrati non la rinnovano
+            if filepath and os.path.getmtime(filepath) >= since:
+                return conversion
+        return None
     
-    def _detect_gender(self, nome, element):
-        """Detecta genere prodotto"""
-        nome_lower = nome.lower()
+    def get(self, key, build, reuse=True, progress=None):
+        """
+        Conversione per key: (risposta, None) se costruita qui, (None, conversione) se
+        riutilizzata. build() restituisce (risposta, conversione registrata). La fase
+        'reuse' misura solo la ricerca e l'attesa di una richiesta identica in corso.
+        """
+        if reuse:
+            with track_stage(progress, 'reuse'):
+                conversion = self.find(key)
+            if conversion:
+                with self.lock:
+                    self.hits += 1
+                return None, conversion
         
-        female_keywords = ['woman', 'women', 'donna', 'female', 'ladies', 'girl']
-        male_keywords = ['man', 'men', 'uomo', 'male', 'mens', 'boy']
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
         
-        if any(kw in nome_lower for kw in female_keywords):
-            return 'F'
-        elif any(kw in nome_lower for kw in male_keywords):
-            return 'M'
+        if not leader:
+            with track_stage(progress, 'reuse'):
+                conversion_id = future.result()
+            conversion = db.session.get(Conversion, conversion_id) if conversion_id else None
+            if conversion:
+                return None, conversion
+            # Conversione del leader non registrata: si costruisce in proprio
+            return build()[0], None
         
-        return 'Unisex'
+        try:
+            response, conversion = build()
+            future.set_result(conversion.id if conversion else None)
+            return response, None
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
     
-    def _detect_season(self):
-        """Determina stagione attuale"""
-        month = datetime.now().month
-        year = datetime.now().year
-        
-        if month >= 3 and month <= 8:
-            return f'SS{year % 100}'  # Spring/Summer
-        else:
-            return f'FW{year % 100}'  # Fall/Winter
+    def stats(self):
+        with self.lock:
+            return {
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'inflight': len(self.inflight)
+            }
+
+conversion_results = ConversionResults(Config.RESULT_REUSE_TTL)
+
+def run_conversion(url, strategy, include_images, max_products, analyze_competitors,
+                   user_id=None, progress=None, reuse=True):
+    """Pipeline completa: estrazione, AI, Excel e salvataggio nel DB (o riuso di un risultato recente)"""
     
-    def _detect_subcategory(self, category):
-        """Determina sottocategoria"""
-        subcats = {
-            'BAGS': ['Shoulder Bags', 'Tote Bags', 'Clutches', 'Crossbody'],
-            'SHOES': ['Pumps', 'Sneakers', 'Boots', 'Sandals', 'Flats'],
-            'READY-TO-WEAR': ['Dresses', 'Outerwear', 'Knitwear', 'Shirts'],
-            'ACCESSORIES': ['Belts', 'Scarves', 'Jewelry', 'Sunglasses']
-        }
-        
-        return random.choice(subcats.get(category, ['Premium Items']))
+    key = (user_id, url_hash(url), strategy, include_images, max_products, analyze_competitors)
     
-    def _detect_color(self, nome, element):
-        """Detecta o assegna colore"""
-        colors = {
-            'black': 'NERO', 'white': 'BIANCO', 'red': 'ROSSO',
-            'blue': 'BLU', 'green': 'VERDE', 'brown': 'MARRONE',
-            'grey': 'GRIGIO', 'beige': 'BEIGE', 'pink': 'ROSA'
-        }
-        
-        nome_lower = nome.lower()
-        for eng, ita in colors.items():
-            if eng in nome_lower:
-                return ita
-        
-        # Colori luxury default
-        return random.choice(['NERO', 'CAMMELLO', 'AVORIO', 'COGNAC', 'BORDEAUX'])
+    def build():
+        extractor = StealthExtractor(include_images=include_images)
+        try:
+            return _run_conversion(extractor, url, strategy, include_images, max_products,
+                                   analyze_competitors, user_id, progress)
+        finally:
+            extractor.close()
     
-    def _generate_sizes(self, category):
-        """Genera taglie disponibili per categoria"""
-        size_maps = {
-            'BAGS': ['UNI'],
-            'SHOES': ['35', '36', '37', '38', '39', '40', '41', '42'],
-            'READY-TO-WEAR': ['XS', 'S', 'M', 'L', 'XL'],
-            'ACCESSORIES': ['70', '75', '80', '85', '90', '95', '100', '105'],
-            'SMALL LEATHER': ['UNI']
-        }
-        
-        sizes = size_maps.get(category, ['UNI'])
-        # Rimuovi random alcune taglie per realismo
-        if len(sizes) > 3:
-            available = random.sample(sizes, k=random.randint(len(sizes)-2, len(sizes)))
-            return sorted(available)
-        return sizes
+    response, reused = conversion_results.get(key, build, reuse, progress)
+    if response:
+        return response
+    
+    # Stesso file per l'utente: lo storico e il conteggio restano completi
+    if user_id:
+        with track_stage(progress, 'db'):
+            record_conversion(user_id, url, strategy, {
+                'products_count': reused.products_count,
+                'margin_avg': reused.avg_margin,
+                'total_proposto': reused.total_value,
+                'filename': reused.file_generated
+            }, json.loads(reused.competitor_data) if reused.competitor_data else None,
+                include_images, max_products, analyze_competitors)
+    
+    response = conversion_response(
+        reused.file_generated, reused.products_count, reused.total_value, reused.avg_margin,
+        include_images, analyze_competitors, ai_insights_summary() if reused.competitor_data else None,
+        progress
+    )
+    response['stats']['reused_from'] = reused.created_at.isoformat(timespec='seconds')
+    response['message'] = 'Conversione recente riutilizzata: stesso catalogo e stesse opzioni'
+    return response
 
-# ====================================
-# 📊 GENERATORE EXCEL B2B PROFESSIONAL
-# ====================================
+def ai_insights_summary():
+    """AI Insights mostrati quando l'analisi di mercato ha prodotto dati"""
+    return {
+        'market_position': 'competitive',
+        'suggested_margin': '45-55%',
+        'confidence': 90,
+        'competitors_analyzed': list(Config.COMPETITOR_SITES.keys())
+    }
 
-class B2BExcelGenerator:
-    """Genera Excel professionali per clienti B2B con immagini HD"""
+def conversion_response(filename, products_count, total_value, margin_avg, include_images,
+                        analyze_competitors, ai_insights, progress):
+    """Risposta JSON di una conversione (nuova o riutilizzata)"""
+    timings = progress.to_dict()['timings'] if progress else {}
+    elapsed = progress.elapsed if progress else sum(timings.values())
     
-    def __init__(self):
-        self.setup_styles()
+    return {
+        'success': True,
+        'download_url': f"/api/download/{filename}",
+        'stats': {
+            'products_count': products_count,
+            'total_value': f"€{total_value:,.0f}",
+            'average_discount': f"{margin_avg:.1f}%",
+            'processing_time': f"{elapsed:.1f}s",
+            'stage_timings': timings,
+            'includes_images': include_images,
+            'ai_analysis': analyze_competitors,
+            'ai_insights': ai_insights if ai_insights else None
+        },
+        'message': 'Conversione completata con successo!' +
+                  (' - AI CompetitorIntelligence applicata' if analyze_competitors else '')
+    }
+
+def _run_conversion(extractor, url, strategy, include_images, max_products, analyze_competitors,
+                    user_id, progress):
+    """Fasi della pipeline (l'estrattore viene chiuso dal chiamante)"""
     
-    def setup_styles(self):
-        """Stili professionali luxury"""
-        # Header style
-        self.header_style = NamedStyle(name='b2b_header')
-        self.header_style.font = Font(bold=True, size=11, name='Arial', color='FFFFFF')
-        self.header_style.fill = PatternFill('solid', fgColor='2C3E50')
-        self.header_style.alignment = Alignment(horizontal='center', vertical='center')
-        self.header_style.border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
-        )
+    # Estrazione prodotti
+    products = extractor.extract_products(url, max_products, progress=progress)
     
-    def create_b2b_excel(self, products, strategy='BALANCED', market_data=None, include_images=False):
-        """Crea Excel B2B professionale con analisi competitor nascosta"""
-        
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "STOCK LIST B2B"
-        
-        # Headers professionali B2B
-        headers = [
-            'STG', 'MACRO', 'Gender', 'Desc. Product Group', 'Foto',
-            'Sku', 'Collezione', 'Modello', 'Parte', 'Colore',
-            'prezzo rtl', 'prezzo proposto', 'sconto rtl %', 'sconto ACC %',
-            'tot Q.TY', 'SELEZIONE lux lab'
-        ]
-        
-        # Aggiungi headers per taglie
-        all_sizes = set()
-        for product in products:
-            if 'taglie' in product:
-                all_sizes.update(product['taglie'])
-        
-        size_headers = sorted(list(all_sizes))
-        headers.extend(size_headers)
-        headers.append('Note')
-        
-        # Scrivi headers
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, size=10)
-            cell.fill = PatternFill('solid', fgColor='D5D8DC')
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Larghezza colonne ottimizzata
-        column_widths = {
-            'A': 12, 'B': 15, 'C': 8, 'D': 20, 'E': 12 if include_images else 8,
-            'F': 15, 'G': 12, 'H': 30, 'I': 15, 'J': 12,
-            'K': 12, 'L': 12, 'M': 10, 'N': 10, 'O': 8, 'P': 10
-        }
-        
-        for col, width in column_widths.items():
-            ws.column_dimensions[col].width = width
-        
-        # Se include immagini, imposta altezza righe
-        if include_images:
-            ws.row_dimensions[1].height = 20  # Header
-        
-        # Intelligence system
-        intelligence = CompetitorIntelligence()
-        
-        # Popola dati prodotti
-        total_retail = 0
-        total_proposto = 0
-        
-        for row_idx, product in enumerate(products, 2):
-            # Se include immagini, imposta altezza riga
-            if include_images:
-                ws.row_dimensions[row_idx].height = 90
-            
-            # Analisi competitor AI (se abilitata)
-            product_market_data = None
-            if market_data:
-                # Usa i dati nascosti del prodotto per analisi AI
-                hidden_name = product.get('original_name_hidden', product['Modello'])
-                product_market_data = intelligence.analyze_market(hidden_name, product['MACRO'])
-            
-            # AI calcola prezzi B2B intelligenti
-            pricing = intelligence.calculate_smart_price(
-                product['prezzo_rtl'], 
-                strategy, 
-                product_market_data
-            )
-            
-            # Dati base
-            ws.cell(row_idx, 1, product['STG'])
-            ws.cell(row_idx, 2, product['MACRO'])
-            ws.cell(row_idx, 3, product['Gender'])
-            ws.cell(row_idx, 4, product['Desc_Product_Group'])
-            
-            # Immagine o placeholder
-            if include_images and product.get('Foto'):
-                try:
-                    img = XLImage(BytesIO(product['Foto']))
-                    img.width = 80
-                    img.height = 80
-                    ws.add_image(img, f'E{row_idx}')
-                except:
-                    ws.cell(row_idx, 5, 'IMG')
-            else:
-                ws.cell(row_idx, 5, '📷' if include_images else '-')
-            
-            ws.cell(row_idx, 6, product['Sku'])
-            ws.cell(row_idx, 7, product['Collezione'])
-            ws.cell(row_idx, 8, product['Modello'])
-            ws.cell(row_idx, 9, product['Parte'])
-            ws.cell(row_idx, 10, product['Colore'])
-            
-            # Prezzi (MAI mostrare dati competitor)
-            ws.cell(row_idx, 11, pricing['retail']).number_format = '€#,##0'
-            ws.cell(row_idx, 12, pricing['proposed']).number_format = '€#,##0'
-            ws.cell(row_idx, 13, f"-{pricing['discount']}%")
-            ws.cell(row_idx, 14, f"-{pricing['discount']}%")
-            ws.cell(row_idx, 15, product['tot_QTY'])
-            ws.cell(row_idx, 16, product['SELEZIONE_luxlab'])
-            
-            # Quantità per taglia
-            col_offset = 17
-            for size_col, size in enumerate(size_headers):
-                if size in product.get('taglie', []):
-                    qty = random.choices([0, 1, 2, 3, 4], weights=[20, 30, 25, 15, 10])[0]
-                    ws.cell(row_idx, col_offset + size_col, qty)
-                else:
-                    ws.cell(row_idx, col_offset + size_col, 0)
-            
-            # Note
-            ws.cell(row_idx, len(headers), product.get('Note', ''))
-            
-            # Totali
-            total_retail += pricing['retail']
-            total_proposto += pricing['proposed']
-            
-            # Formattazione alternata righe
-            if row_idx % 2 == 0:
-                for col in range(1, len(headers) + 1):
-                    ws.cell(row_idx, col).fill = PatternFill('solid', fgColor='F8F9F9')
-        
-        # Riga totali
-        total_row = len(products) + 3
-        ws.cell(total_row, 10, 'TOTALI:').font = Font(bold=True, size=12)
-        ws.cell(total_row, 11, total_retail).number_format = '€#,##0'
-        ws.cell(total_row, 11).font = Font(bold=True)
-        ws.cell(total_row, 12, total_proposto).number_format = '€#,##0'
-        ws.cell(total_row, 12).font = Font(bold=True, color='27AE60')
-        
-        # Info sheet (senza dati competitor)
-        info_sheet = wb.create_sheet('INFO')
-        info_data = [
-            ['LUXLAB B2B STOCK LIST', ''],
-            ['', ''],
-            ['Data Generazione:', datetime.now().strftime('%d/%m/%Y %H:%M')],
-            ['Strategia Applicata:', strategy],
-            ['Prodotti Totali:', len(products)],
-            ['Valore Retail:', f'€{total_retail:,.0f}'],
-            ['Valore Proposto:', f'€{total_proposto:,.0f}'],
-            ['Risparmio Medio:', f'{((total_retail-total_proposto)/total_retail*100):.1f}%' if total_retail > 0 else '0%'],
-            ['', ''],
-            ['AI Analysis:', 'ATTIVA' if market_data else 'NON ATTIVA'],
-            ['', ''],
-            ['CONFIDENZIALE', 'Documento riservato B2B']
-        ]
-        
-        for row_idx, (label, value) in enumerate(info_data, 1):
-            info_sheet.cell(row_idx, 1, label).font = Font(bold=True)
-            info_sheet.cell(row_idx, 2, value)
-        
-        # Salva file
-        filename = f"LUXLAB_B2B_{strategy}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        filepath = os.path.join(Config.EXPORT_PATH, filename)
-        wb.save(filepath)
+    if not products:
+        raise ConversionError('Nessun prodotto trovato', 404)
+    
+    # CompetitorIntelligence AI Analysis (se abilitata)
+    market_data = None
+    ai_insights = None
+    
+    if analyze_competitors:
+        with track_stage(progress, 'analysis'):
+            # AI analizza campione prodotti
+            intelligence = CompetitorIntelligence()
+            # AI analizza primi 5 come campione
+            sample_market_data = intelligence.analyze_market_batch(products[:5])
         
-        return {
-            'filename': filename,
-            'filepath': filepath,
-            'products_count': len(products),
-            'total_retail': total_retail,
-            'total_proposto': total_proposto,
-            'margin_avg': ((total_retail-total_proposto)/total_retail*100) if total_retail > 0 else 0
-        }
+        # AI aggregazione dati mercato
+        if sample_market_data:
+            avg_prices = [d.get('avg_price', 0) for d in sample_market_data if d.get('avg_price')]
+            if avg_prices:
+                market_data = {
+                    'avg_price': sum(avg_prices) / len(avg_prices),
+                    'ai_analyzed': True,
+                    'ai_system': 'CompetitorIntelligence v2.0',
+                    'competitors_checked': len(Config.COMPETITOR_SITES)
+                }
+                
+                # AI Insights
+                ai_insights = ai_insights_summary()
+    
+    # Generazione Excel B2B con AI data
+    with track_stage(progress, 'excel'):
+        generator = B2BExcelGenerator()
+        result = generator.create_b2b_excel(
+            products, 
+            strategy, 
+            market_data,
+            include_images,
+            progress=progress
+        )
+    
+    # Analisi di mercato nuove sul DB, condivise con gli altri worker
+    if analyze_competitors:
+        with track_stage(progress, 'db'):
+            get_market_cache().flush()
+    
+    # Salva conversione nel DB (anche anonima, per il riuso)
+    with track_stage(progress, 'db'):
+        conversion = record_conversion(user_id, url, strategy, result, market_data,
+                                       include_images, max_products, analyze_competitors)
+    
+    response = conversion_response(
+        result['filename'], result['products_count'], result['total_proposto'], result['margin_avg'],
+        include_images, analyze_competitors, ai_insights, progress
+    )
+    return response, conversion
+
+@metrics.collector
+def runtime_metrics():
+    """Statistiche già tenute da cache, coda job e ammissione (senza creare pool non ancora usati)"""
+    lookups = ('luxlab_cache_lookups_total', 'counter', 'Ricerche nelle cache per esito')
+    evictions = ('luxlab_cache_evictions_total', 'counter', 'Voci rimosse dalle cache per spazio')
+    entries = ('luxlab_cache_entries', 'gauge', 'Voci presenti nelle cache in memoria')
+    
+    caches = [('user', user_cache.stats(), ('hits', 'misses')),
+              ('conversion', conversion_results.stats(), ('hits', 'misses', 'coalesced'))]
+    if _page_fetcher:
+        caches.append(('page', _page_fetcher.cache.stats(), ('hits', 'revalidated', 'misses')))
+    if _image_pipeline:
+        caches.append(('image', _image_pipeline.cache.stats(), ('hits', 'misses')))
+    if _market_cache:
+        caches.append(('market', _market_cache.stats(), ('hits', 'db_hits', 'misses')))
+    
+    for cache, stats, results in caches:
+        for result in results:
+            yield (*lookups, {'cache': cache, 'result': result}, stats[result])
+        if 'evicted' in stats:
+            yield (*evictions, {'cache': cache}, stats['evicted'])
+        if 'entries' in stats:
+            yield (*entries, {'cache': cache}, stats['entries'])
+    
+    with job_manager.lock:
+        queued = len(job_manager.queue)
+        running = sum(1 for job in job_manager.jobs.values() if job.status == 'running')
+    yield 'luxlab_jobs', 'gauge', 'Job di conversione per stato', {'status': 'queued'}, queued
+    yield 'luxlab_jobs', 'gauge', 'Job di conversione per stato', {'status': 'running'}, running
+    
+    stats = admission.stats()
+    yield 'luxlab_admission_admitted_total', 'counter', 'Richieste ammesse', {}, stats['admitted']
+    for reason, denied in stats['denied'].items():
+        yield 'luxlab_admission_denied_total', 'counter', 'Richieste rifiutate (429) per motivo', {'reason': reason}, denied
+    for lane, in_flight in stats['in_flight'].items():
+        yield 'luxlab_admission_in_flight', 'gauge', 'Conversioni in corso per corsia', {'lane': lane}, in_flight
+    
+    if _export_janitor:
+        janitor = _export_janitor.stats()
+        yield 'luxlab_export_reclaimed_bytes_total', 'counter', 'Bytes liberati dal janitor export', {}, janitor['bytes_reclaimed']
 
 # ====================================
 # JWT AUTH
@@ -946,12 +3903,12 @@ def generate_jwt_token(user):
         'is_admin': user.is_admin,
         'exp': datetime.utcnow() + timedelta(days=30)
     }
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
+    return jwt.encode(payload, current_app.config['SECRET_KEY'], algorithm='HS256')
 
 def verify_jwt_token(token):
     """Verifica JWT token"""
     try:
-        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
+        return jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
     except:
         return None
 
@@ -975,16 +3932,25 @@ def token_required(f):
         return f(*args, **kwargs)
     return decorated
 
+def caller_user_id(trial_token=None):
+    """Utente che chiama (trial_token oppure JWT Bearer, come /api/convert); None se anonimo"""
+    if trial_token:
+        user = User.query.filter_by(token=trial_token).first()
+        return user.id if user else None
+    token = request.headers.get('Authorization', '').replace('Bearer ', '')
+    payload = verify_jwt_token(token) if token else None
+    return payload['user_id'] if payload else None
+
 # ====================================
 # 🚀 ROUTES API
 # ====================================
 
-@app.route('/')
+@api.route('/')
 def index():
     """Homepage B2B"""
     return render_template('index.html')
 
-@app.route('/api/health')
+@api.route('/api/health')
 def health():
     """Health check"""
     return jsonify({
@@ -998,10 +3964,28 @@ def health():
             'smart_pricing': True,
             'ai_enabled': True
         },
+        # Solo componenti già creati: una sonda non deve importare PIL né avviare pool e janitor
+        'image_cache': _image_pipeline.cache.stats() if _image_pipeline else 'not initialised',
+        'page_cache': _page_fetcher.cache.stats() if _page_fetcher else 'not initialised',
+        'http_pools': _http_clients.stats() if _http_clients else 'not initialised',
+        'market_cache': _market_cache.stats() if _market_cache else 'not initialised',
+        'exports': _export_janitor.stats() if _export_janitor else 'not initialised',
+        'conversion_reuse': conversion_results.stats(),
+        'user_cache': user_cache.stats(),
+        'admission': admission.stats(),
         'timestamp': datetime.now().isoformat()
     })
 
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/metrics')
+def prometheus_metrics():
+    """Metriche del processo in formato testo Prometheus (fasi, bytes, immagini, cache)"""
+    if Config.METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not secrets.compare_digest(supplied, f"Bearer {Config.METRICS_TOKEN}"):
+            return jsonify({'error': 'Token metriche non valido'}), 401
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api.route('/api/register', methods=['POST'])
 def register():
     """Registrazione con TOKEN PROVA GRATIS con AI"""
     try:
@@ -1031,7 +4015,12 @@ def register():
         user.generate_token()  # TOKEN GRATIS!
         
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Stessa email registrata in parallelo da un'altra richiesta
+            db.session.rollback()
+            return jsonify({'error': 'Email già registrata'}), 400
         
         # Genera JWT
         jwt_token = generate_jwt_token(user)
@@ -1048,10 +4037,12 @@ def register():
                       '⏰ Valido per 24 ore'
         })
         
+    except PasswordHashBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '2'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     """Login utente"""
     try:
@@ -1077,10 +4068,12 @@ def login():
             'user': user.to_dict()
         })
         
+    except PasswordHashBusy as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '2'}
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/analyze', methods=['POST'])
+@api.route('/api/analyze', methods=['POST'])
 def analyze_url():
     """Analisi preliminare URL con AI suggerimenti strategia"""
     try:
@@ -1095,28 +4088,30 @@ def analyze_url():
         if token:
             payload = verify_jwt_token(token)
             if payload:
-                user = User.query.get(payload['user_id'])
+                user = user_cache.get(payload['user_id'])
                 if user:
                     has_ai = user.can_analyze_competitors()
         
         if not url:
             return jsonify({'error': 'URL richiesto'}), 400
         
-        # Quick extraction
-        extractor = StealthExtractor()
-        products = extractor.extract_products(url, max_products=5)
-        
-        # Se utente ha AI (trial, professional, enterprise)
-        suggested_strategy = None
-        if has_ai and products:
-            intelligence = CompetitorIntelligence()
-            # AI analizza primo prodotto come campione
-            sample_product = products[0]
-            market_data = intelligence.analyze_market(
-                sample_product.get('original_name_hidden', 'Sample'),
-                sample_product.get('MACRO')
-            )
-            suggested_strategy = market_data.get('suggested_strategy')
+        with admission.admit(*admission_limits(user)):
+            # Quick extraction
+            extractor = StealthExtractor()
+            products = extractor.extract_products(url, max_products=5)
+            
+            # Se utente ha AI (trial, professional, enterprise)
+            suggested_strategy = None
+            if has_ai and products:
+                intelligence = CompetitorIntelligence()
+                # AI analizza primo prodotto come campione
+                sample_product = products[0]
+                market_data = intelligence.analyze_market(
+                    sample_product.get('original_name_hidden', 'Sample'),
+                    sample_product.get('MACRO')
+                )
+                suggested_strategy = market_data.get('suggested_strategy')
+                get_market_cache().flush()
         
         return jsonify({
             'success': True,
@@ -1129,10 +4124,12 @@ def analyze_url():
                       (" - AI analysis attiva" if has_ai else "")
         })
         
+    except AdmissionDenied as e:
+        return admission_denied(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/convert', methods=['POST'])
+@api.route('/api/convert', methods=['POST'])
 def convert_catalog():
     """Conversione principale con CompetitorIntelligence AI"""
     try:
@@ -1159,9 +4156,6 @@ def convert_catalog():
                 include_images = True
                 max_products = 10
                 analyze_competitors = True  # AI INCLUSA NEL TRIAL!
-                
-                user.trial_used = True
-                db.session.commit()
             else:
                 return jsonify({'error': 'Token trial già utilizzato o non valido'}), 403
         else:
@@ -1175,7 +4169,7 @@ def convert_catalog():
             else:
                 payload = verify_jwt_token(token)
                 if payload:
-                    user = User.query.get(payload['user_id'])
+                    user = user_cache.get(payload['user_id'])
                     if user:
                         # Check limiti piano
                         plan_limits = user.get_plan_limits()
@@ -1183,109 +4177,108 @@ def convert_catalog():
                         include_images = plan_limits['images']
                         analyze_competitors = plan_limits['competitor_analysis']  # AI!
         
-        # Estrazione prodotti
-        extractor = StealthExtractor(include_images=include_images)
-        products = extractor.extract_products(url, max_products)
-        
-        if not products:
-            return jsonify({'error': 'Nessun prodotto trovato'}), 404
-        
-        # CompetitorIntelligence AI Analysis (se abilitata)
-        market_data = None
-        ai_insights = None
-        
-        if analyze_competitors:
-            # AI analizza campione prodotti
-            intelligence = CompetitorIntelligence()
-            sample_market_data = []
-            
-            for p in products[:5]:  # AI analizza primi 5 come campione
-                pd = intelligence.analyze_market(
-                    p.get('original_name_hidden', p['Modello']),
-                    p['MACRO']
-                )
-                sample_market_data.append(pd)
+        # Ammissione prima di consumare il trial: un 429 non lo fa perdere
+        ticket = admission.admit(*admission_limits(user))
+        try:
+            if trial_token and not claim_trial(user.id):
+                ticket.release()
+                return jsonify({'error': 'Token trial già utilizzato o non valido'}), 403
             
-            # AI aggregazione dati mercato
-            if sample_market_data:
-                avg_prices = [d.get('avg_price', 0) for d in sample_market_data if d.get('avg_price')]
-                if avg_prices:
-                    market_data = {
-                        'avg_price': sum(avg_prices) / len(avg_prices),
-                        'ai_analyzed': True,
-                        'ai_system': 'CompetitorIntelligence v2.0',
-                        'competitors_checked': len(Config.COMPETITOR_SITES)
-                    }
-                    
-                    # AI Insights
-                    ai_insights = {
-                        'market_position': 'competitive',
-                        'suggested_margin': '45-55%',
-                        'confidence': 90,
-                        'competitors_analyzed': list(Config.COMPETITOR_SITES.keys())
-                    }
-        
-        # Generazione Excel B2B con AI data
-        generator = B2BExcelGenerator()
-        result = generator.create_b2b_excel(
-            products, 
-            strategy, 
-            market_data,
-            include_images
-        )
-        
-        # Salva conversione nel DB
-        if user:
-            conversion = Conversion(
-                user_id=user.id,
-                url_hash=hashlib.md5(url.encode()).hexdigest(),
-                strategy=strategy,
-                products_count=result['products_count'],
-                avg_margin=result['margin_avg'],
-                total_value=result['total_proposto'],
-                competitor_data=json.dumps(market_data) if market_data else None,
-                file_generated=result['filename']
-            )
-            db.session.add(conversion)
+            user_id = user.id if user else None
+            options = (url, strategy, include_images, max_products, analyze_competitors)
+            reuse = not data.get('refresh')  # refresh: true forza una nuova estrazione
             
-            user.total_conversions += 1
-            db.session.commit()
+            # Job mode: risponde subito, la pipeline gira nel pool locale (il posto si libera a fine job)
+            if data.get('async'):
+                job = job_manager.submit(run_conversion, *options, user_id=user_id, reuse=reuse,
+                                         priority=ticket.priority, on_finish=ticket.release)
+                return jsonify({
+                    'success': True,
+                    'job_id': job.id,
+                    'status_url': f"/api/jobs/{job.id}"
+                }), 202
+        except Exception:
+            # Errore prima della consegna al job (es. DB bloccato nel claim del trial): il posto si libera
+            ticket.release()
+            raise
         
-        return jsonify({
-            'success': True,
-            'download_url': f"/api/download/{result['filename']}",
-            'stats': {
-                'products_count': result['products_count'],
-                'total_value': f"€{result['total_proposto']:,.0f}",
-                'average_discount': f"{result['margin_avg']:.1f}%",
-                'processing_time': f"{random.randint(35, 55)}s",
-                'includes_images': include_images,
-                'ai_analysis': analyze_competitors,
-                'ai_insights': ai_insights if ai_insights else None
-            },
-            'message': 'Conversione completata con successo!' +
-                      (' - AI CompetitorIntelligence applicata' if analyze_competitors else '')
-        })
+        with ticket:
+            job = ConversionJob(user_id)
+            job.started_at = time.time()
+            return jsonify(run_conversion(*options, user_id=user_id, progress=job, reuse=reuse))
         
+    except AdmissionDenied as e:
+        return admission_denied(e)
+    except ConversionError as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         print(f"Errore conversione: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/download/<filename>')
+@api.route('/api/export', methods=['POST'])
+@token_required
+def export_catalog():
+    """Export CSV/NDJSON in streaming per integrazioni (piani con api_access)"""
+    data = request.json or {}
+    url = data.get('url', '').strip()
+    strategy = data.get('strategy', 'BALANCED')
+    export_format = data.get('format', 'csv').lower()
+    
+    if not url:
+        return jsonify({'error': 'URL richiesto'}), 400
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Formato non supportato: usa {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    user = user_cache.get(request.current_user_id)
+    if not user:
+        return jsonify({'error': 'Utente non trovato'}), 404
+    plan_limits = user.get_plan_limits()
+    if not (plan_limits.get('api_access') or user.is_admin):
+        return jsonify({'error': 'Export API disponibile solo con piano Enterprise'}), 403
+    
+    try:
+        ticket = admission.admit(*admission_limits(user))
+    except AdmissionDenied as e:
+        return admission_denied(e)
+    
+    mimetype, extension, _ = EXPORT_FORMATS[export_format]
+    filename = export_filename(strategy, extension)
+    stream = export_stream(url, strategy, export_format, plan_limits['products'],
+                           plan_limits['competitor_analysis'], user_id=user.id)
+    response = Response(stream_with_context(stream), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'  # Niente buffering nei proxy nginx
+    })
+    # Il posto resta occupato per tutto lo streaming (anche se il client si disconnette prima)
+    response.call_on_close(ticket.release)
+    return response
+
+@api.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """Stato e progresso reale di una conversione in background"""
+    job = job_manager.get(job_id)
+    # Il job di un utente è visibile solo a lui; per quelli anonimi basta l'id
+    if not job or (job.user_id and job.user_id != caller_user_id(request.args.get('trial_token'))):
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    return jsonify({
+        'success': True,
+        **job.to_dict()
+    })
+
+@api.route('/api/download/<filename>')
 def download_file(filename):
-    """Download Excel generato"""
+    """Download Excel generato (ETag, 304 e Range)"""
+    filepath = export_file_path(filename)
+    if not filepath:
+        return jsonify({'error': 'File non trovato'}), 404
     try:
-        filepath = os.path.join(Config.EXPORT_PATH, filename)
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-    except:
+        return export_response(filepath, filename)
+    except OSError:
         return jsonify({'error': 'File non trovato'}), 404
 
-@app.route('/api/user/profile')
+@api.route('/api/user/profile')
 @token_required
 def user_profile():
     """Profilo utente"""
@@ -1301,7 +4294,58 @@ def user_profile():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/checkout', methods=['POST'])
+def encode_history_cursor(conversion):
+    """Cursore opaco: posizione (created_at, id) dell'ultima conversione della pagina"""
+    raw = f"{conversion.created_at.isoformat()}|{conversion.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    """(created_at, id) dal cursore, ValueError se non valido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, conversion_id = raw.split('|')
+        return datetime.fromisoformat(created_at), int(conversion_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Cursore non valido') from e
+
+def conversion_history(user_id, cursor=None, limit=Config.HISTORY_PAGE_SIZE):
+    """
+    Pagina di storico dalla più recente, in keyset pagination su ix_conversions_user_created:
+    ogni pagina parte dalla posizione del cursore invece di saltare N righe con OFFSET,
+    quindi costa uguale anche dopo decine di migliaia di conversioni.
+    """
+    query = Conversion.query.filter(Conversion.user_id == user_id)
+    if cursor:
+        created_at, conversion_id = decode_history_cursor(cursor)
+        # created_at <= c delimita il range sull'indice, il resto risolve i pari merito
+        query = query.filter(
+            Conversion.created_at <= created_at,
+            db.or_(Conversion.created_at < created_at, Conversion.id < conversion_id)
+        )
+    rows = query.order_by(Conversion.created_at.desc(), Conversion.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, encode_history_cursor(rows[-1]) if has_more else None
+
+@api.route('/api/user/conversions')
+@token_required
+def user_conversions():
+    """Storico conversioni dell'utente (?limit=, ?cursor= dalla pagina precedente)"""
+    try:
+        limit = min(max(request.args.get('limit', Config.HISTORY_PAGE_SIZE, type=int), 1),
+                    Config.HISTORY_MAX_PAGE_SIZE)
+        rows, next_cursor = conversion_history(request.current_user_id, request.args.get('cursor'), limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'conversions': [conversion.to_dict() for conversion in rows],
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    })
+
+@api.route('/api/checkout', methods=['POST'])
 def create_checkout():
     """Crea sessione Stripe checkout"""
     try:
@@ -1317,6 +4361,7 @@ def create_checkout():
         
         # Crea sessione Stripe
         session = stripe.checkout.Session.create(
+            api_key=Config.STRIPE_SECRET_KEY or None,
             payment_method_types=['card'],
             line_items=[{
                 'price_data': {
@@ -1346,10 +4391,93 @@ def create_checkout():
 # INIZIALIZZAZIONE
 # ====================================
 
-def init_database():
-    """Inizializza database con utenti speciali"""
+def upgrade_schema():
+    """
+    Allinea un database esistente ai modelli: create_all crea solo le tabelle
+    mancanti, qui si aggiungono colonne (nullable) e indici introdotti o cambiati dopo.
+    """
+    inspector = db_inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"🔧 Colonna aggiunta: {table.name}.{column.name}")
+        existing_indexes = {index['name']: index['column_names'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if existing_indexes.get(index.name, index.columns.keys()) != index.columns.keys():
+                index.drop(db.engine)  # Stesso nome, colonne cambiate: si ricrea
+                print(f"🔧 Indice ricreato: {index.name}")
+            index.create(db.engine, checkfirst=True)
+
+def create_app(config=None):
+    """
+    Crea l'app Flask: configurazione, database, CORS e route. Le librerie pesanti
+    e i client (HTTP, pool immagini, hashing) partono al primo uso o con warm_up().
+    """
+    flask_app = Flask(__name__)
+    
+    # Configurazioni
+    flask_app.config['SECRET_KEY'] = Config.SECRET_KEY
+    flask_app.config['SQLALCHEMY_DATABASE_URI'] = Config.DATABASE_URL
+    flask_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    flask_app.config['TEMPLATES_AUTO_RELOAD'] = True
+    flask_app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
+    flask_app.config.update(config or {})
+    flask_app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                                database_engine_options(flask_app.config['SQLALCHEMY_DATABASE_URI']))
+    
+    db.init_app(flask_app)
+    with flask_app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', set_sqlite_pragmas)
+    CORS(flask_app, supports_credentials=True)
+    if Config.TRUSTED_PROXIES:
+        # remote_addr (chiave di ammissione degli anonimi) e schema dal proxy, non dal socket
+        flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=Config.TRUSTED_PROXIES,
+                                      x_proto=Config.TRUSTED_PROXIES, x_host=Config.TRUSTED_PROXIES)
+    flask_app.register_blueprint(api)
+    
+    # Create directories
+    for path in [Config.EXPORT_PATH, Config.TEMP_PATH, Config.LOGS_PATH]:
+        os.makedirs(path, exist_ok=True)
+    
+    return flask_app
+
+def warm_imports():
+    """Importa subito le librerie lazy (nel master gunicorn: condivise dai worker dopo il fork)"""
+    for module in LazyImport.registry:
+        try:
+            module._load()
+        except ImportError:
+            pass  # Dipendenza opzionale non installata
+
+def warm_up():
+    """Prepara il worker prima delle prime richieste: librerie e client del processo"""
+    warm_imports()
+    get_user_agents()
+    get_http_clients().scraper()  # Crea gli adapter TLS condivisi dagli scraper dei thread
+    get_page_fetcher()
+
+def reset_after_fork():
+    """
+    Nel worker appena creato: le connessioni DB aperte dal master non vanno
+    condivise e i thread del pool hashing non sopravvivono al fork.
+    """
+    global _password_hasher
     with app.app_context():
+        db.engine.dispose(close=False)
+    _password_hasher = None
+
+def init_database(flask_app=None):
+    """Inizializza database con utenti speciali"""
+    with (flask_app or app).app_context():
         db.create_all()
+        upgrade_schema()
         
         # Admin account
         admin = User.query.filter_by(email='admin@luxlab.it').first()
@@ -1384,6 +4512,8 @@ def init_database():
         db.session.commit()
         print("✅ Database inizializzato con utenti speciali")
 
+app = create_app()
+
 # ====================================
 # MAIN
 # ====================================
@@ -0,0 +1,31 @@
+"""
+⚙️ LUXLAB - configurazione gunicorn
+Uso: gunicorn -c gunicorn.conf.py app:app
+
+Il master importa app.py una sola volta (preload), crea/aggiorna il database e
+carica le librerie pesanti: i worker nascono con fork già pronti e condividono
+quelle pagine di memoria. Dopo il fork ogni worker chiude le connessioni DB
+ereditate e prepara i propri client in background.
+"""
+
+import os
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300'))  # Conversioni sincrone lunghe
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+def when_ready(server):
+    """Master, prima di avviare i worker"""
+    import app as luxlab
+    luxlab.init_database()
+    if preload_app:
+        luxlab.warm_imports()
+
+def post_fork(server, worker):
+    import app as luxlab
+    luxlab.reset_after_fork()
+    threading.Thread(target=luxlab.warm_up, name='luxlab-warmup', daemon=True).start()